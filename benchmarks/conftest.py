@@ -0,0 +1,131 @@
+"""Fixtures for the serializer benchmark suite.
+
+Synthetic runs are built with the same ``in_memory`` tree and
+``build_app`` pattern as the test suite, and come in a few sizes. A
+single size can be chosen from the command line instead, e.g.
+
+.. code-block:: bash
+
+    pytest benchmarks/ --rows 10000 --columns 20 --streams 2 --frame-shape 8 4096
+
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+
+import pytest
+from nexus_backends import build_run
+from tiled.catalog import in_memory
+
+# Sizes of synthetic runs to benchmark by default
+RUN_SIZES = {
+    "small": {"num_rows": 100, "num_columns": 4, "num_streams": 1, "frame_shape": ()},
+    "wide": {
+        "num_rows": 1000,
+        "num_columns": 50,
+        "num_streams": 1,
+        "frame_shape": (),
+    },
+    "long": {
+        "num_rows": 100000,
+        "num_columns": 4,
+        "num_streams": 1,
+        "frame_shape": (),
+    },
+    "frames": {
+        "num_rows": 200,
+        "num_columns": 4,
+        "num_streams": 2,
+        "frame_shape": (8, 4096),
+    },
+}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("tiledspc", "Synthetic runs for benchmarks")
+    group.addoption("--rows", type=int, help="Events in each stream.")
+    group.addoption("--columns", type=int, default=4, help="Scalar signals.")
+    group.addoption("--streams", type=int, default=1, help="Streams in the run.")
+    group.addoption(
+        "--frame-shape",
+        type=int,
+        nargs="*",
+        default=[],
+        help="Shape of each external detector frame.",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if "run_size" not in metafunc.fixturenames:
+        return
+    config = metafunc.config
+    if config.getoption("rows") is None:
+        sizes = RUN_SIZES
+    else:
+        sizes = {
+            "custom": {
+                "num_rows": config.getoption("rows"),
+                "num_columns": config.getoption("columns"),
+                "num_streams": config.getoption("streams"),
+                "frame_shape": tuple(config.getoption("frame_shape")),
+            }
+        }
+    metafunc.parametrize(
+        "run_size", list(sizes.values()), ids=list(sizes.keys()), scope="module"
+    )
+
+
+@pytest.fixture(scope="module")
+def synthetic_run(run_size, tmp_path_factory):
+    """A tiled tree holding a single synthetic run, and its metadata."""
+    tree = in_memory(writable_storage=tmp_path_factory.mktemp("synthetic_run"))
+    with build_run(tree, **run_size) as metadata:
+        yield tree, metadata
+
+
+def current_rss() -> int:
+    """Resident memory (in bytes) of this process right now."""
+    with open("/proc/self/statm") as fd:
+        pages = int(fd.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    """Track the largest resident memory of the process while active.
+
+    Resident memory is sampled every *interval* seconds from a
+    background thread. On platforms without ``/proc``, the process's
+    lifetime peak (``ru_maxrss``) is used instead.
+
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._done.clear()
+        if os.path.exists("/proc/self/statm"):
+            self._thread = threading.Thread(target=self.sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.peak = max(self.peak, current_rss())
+        else:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Reported in bytes on macOS, kilobytes elsewhere
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
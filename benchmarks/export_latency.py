@@ -0,0 +1,98 @@
+"""Measure how much a large export slows down other requests.
+
+While one large export is running, a probe repeatedly makes a small
+metadata request against the same catalog (as another client would)
+on the same event loop. Latency percentiles for the probe are
+reported for each encoder pool setting. E.g.
+
+.. code-block:: bash
+
+    python benchmarks/export_latency.py --rows 1000000 --format tsv
+
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+import numpy as np
+from nexus_backends import build_run
+from tiled.catalog import in_memory
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.offload import ENCODER_POOLS, run_encoder
+from tiledspc.serialization.tsv import serialize_tsv
+
+SERIALIZERS = {"nexus": serialize_nexus, "tsv": serialize_tsv}
+
+
+async def probe(tree, done: asyncio.Event, interval: float) -> list[float]:
+    """Make small metadata requests until *done* is set.
+
+    Requests "arrive" every *interval* seconds, and each latency is
+    measured from when the request arrived, so time spent waiting for
+    a blocked event loop is included.
+
+    """
+    latencies = []
+    arrival = time.perf_counter()
+    while not done.is_set():
+        await asyncio.sleep(max(arrival - time.perf_counter(), 0))
+        node = await tree.lookup_adapter(["primary"])
+        node.metadata()
+        latencies.append(time.perf_counter() - arrival)
+        arrival = max(arrival + interval, time.perf_counter())
+    return latencies
+
+
+async def measure(tree, metadata, serializer, interval: float):
+    done = asyncio.Event()
+    probe_task = asyncio.create_task(probe(tree, done, interval))
+    t0 = time.perf_counter()
+    await serializer(tree, metadata=metadata, filter_for_access=None, stream=False)
+    export_time = time.perf_counter() - t0
+    done.set()
+    return export_time, await probe_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--frame-shape", type=int, nargs="*", default=[64])
+    parser.add_argument("--format", choices=SERIALIZERS.keys(), default="tsv")
+    parser.add_argument("--pools", nargs="*", default=ENCODER_POOLS)
+    parser.add_argument("--interval", type=float, default=0.01)
+    args = parser.parse_args()
+    serializer = SERIALIZERS[args.format]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tree = in_memory(writable_storage=tmpdir)
+        run = build_run(
+            tree,
+            num_rows=args.rows,
+            num_columns=args.columns,
+            frame_shape=tuple(args.frame_shape),
+        )
+        with run as metadata:
+            print(
+                f"{'pool':<8} {'export (s)':>11} {'requests':>9} "
+                f"{'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}"
+            )
+            for pool in args.pools:
+                settings.ENCODER_POOL = pool
+                # Start up the pool's workers before timing anything
+                asyncio.run(run_encoder(int, pool=pool))
+                export_time, latencies = asyncio.run(
+                    measure(tree, metadata, serializer, interval=args.interval)
+                )
+                p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+                print(
+                    f"{pool:<8} {export_time:>11.2f} {len(latencies):>9} "
+                    f"{p50:>9.1f} {p99:>9.1f} {max(latencies) * 1000:>9.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Compare ways of decoding image pixels for :py:mod:`image_data`.
+
+The original ``list(image.getdata())`` conversion is timed against
+:py:func:`image_data.image_array`, along with the peak memory used
+(from :py:mod:`tracemalloc`) and the resulting data type. Images can
+be given on the command line; otherwise synthetic BMP, PNG and TIFF
+samples are generated. E.g.
+
+.. code-block:: bash
+
+    python benchmarks/image_decoding.py --size 2048
+    python benchmarks/image_decoding.py data/images/*.tif
+
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+# image_data lives at the top of the repository, outside the package
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from image_data import image_array  # noqa: E402
+
+
+def getdata_array(image):
+    """The ``getdata()`` based decoder that :py:func:`image_array` replaced."""
+    im = image.getdata()
+    pixels = list(im)  # 1-D array of int or tuple
+    shape = list(reversed(im.size))
+    if im.bands > 1:
+        shape.append(im.bands)
+    pixels = np.array(pixels).reshape(shape)
+    if len(shape) > 2:
+        pixels = np.moveaxis(pixels, -1, 0)  # put the colors first
+    return pixels
+
+
+def write_samples(directory: pathlib.Path, size: int) -> list[pathlib.Path]:
+    """Write synthetic images in the formats our beamlines produce."""
+    rng = np.random.default_rng()
+    samples = {
+        "rgb.bmp": Image.fromarray(
+            rng.integers(0, 255, (size, size, 3), dtype="u1"), mode="RGB"
+        ),
+        "gray.png": Image.fromarray(rng.integers(0, 255, (size, size), dtype="u1")),
+        "gray16.png": Image.fromarray(rng.integers(0, 2**16, (size, size), dtype="u2")),
+        "gray16.tif": Image.fromarray(rng.integers(0, 2**16, (size, size), dtype="u2")),
+        "float.tif": Image.fromarray(rng.random((size, size), dtype="f4")),
+    }
+    paths = []
+    for name, image in samples.items():
+        path = directory / name
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+def measure(decoder, path):
+    with Image.open(path) as image:
+        # Make sure the file itself is loaded before timing the decoder
+        image.load()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        pixels = decoder(image)
+        wall_time = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return wall_time, peak, pixels.dtype
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("images", nargs="*", type=pathlib.Path)
+    parser.add_argument(
+        "--size", type=int, default=1024, help="Width of the synthetic images."
+    )
+    args = parser.parse_args()
+    decoders = {"getdata": getdata_array, "image_array": image_array}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = args.images or write_samples(pathlib.Path(tmpdir), args.size)
+        print(
+            f"{'image':<16} {'decoder':<12} {'time (s)':>9} "
+            f"{'peak (MB)':>10} {'dtype':>8}"
+        )
+        for path in paths:
+            for name, decoder in decoders.items():
+                wall_time, peak, dtype = measure(decoder, path)
+                print(
+                    f"{path.name:<16} {name:<12} {wall_time:>9.3f} "
+                    f"{peak / 1024**2:>10.1f} {str(dtype):>8}"
+                )
+
+
+if __name__ == "__main__":
+    main()
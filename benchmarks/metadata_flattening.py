@@ -0,0 +1,138 @@
+"""Time flattening and writing run metadata into NeXus files.
+
+Synthetic start documents mimic runs with many devices: long
+``plan_args`` reprs and a configuration dictionary for each device.
+The original per-field writer is compared against
+:py:func:`tiledspc.serialization.nexus.write_metadata_fields`. E.g.
+
+.. code-block:: bash
+
+    python benchmarks/metadata_flattening.py --devices 100 1000 5000
+
+"""
+
+import argparse
+import datetime as dt
+import io
+import json
+import time
+import timeit
+
+import h5py
+
+from tiledspc.serialization.nexus import (
+    NexusIO,
+    flatten_metadata,
+    new_entry,
+    new_field,
+    new_group,
+    write_metadata_fields,
+)
+
+
+def start_document(num_devices: int) -> dict:
+    devices = [f"device{idx}" for idx in range(num_devices)]
+    start = {
+        "uid": "7d1daf1d-60c7-4aa7-a668-d1cd97e5335f",
+        "time": 1665065697.3635247,
+        "plan_name": "xafs_scan",
+        "sample_name": "NMC-811",
+        "detectors": devices[:10],
+        "plan_args": {
+            "detectors": [
+                f"EpicsSignal(prefix='25idc:{dev}', name='{dev}', read_attrs=[])"
+                for dev in devices[:10]
+            ],
+            "energies": list(range(8300, 8700)),
+        },
+        "versions": {"bluesky": "1.9.0", "ophyd": "1.7.0"},
+    }
+    for dev in devices:
+        start[f"{dev}_config"] = {
+            "velocity": 1.5,
+            "acceleration": 0.2,
+            "units": "mm",
+            "read_attrs": ["user_readback", "user_setpoint"],
+        }
+        start[f"{dev}_position"] = 3.14159
+        start[f"{dev}_name"] = dev
+    return {
+        "start": start,
+        "stop": {"time": 1665065735.714015, "exit_status": "success"},
+        "summary": {"datetime": dt.datetime(2022, 10, 6, 9, 14, 57)},
+    }
+
+
+def legacy_to_hdf_type(value):
+    type_conversions = [
+        (dt.datetime, str),
+        (dict, json.dumps),
+        (list, json.dumps),
+    ]
+    new_types = [new for old, new in type_conversions if isinstance(value, old)]
+    new_type = [*new_types, lambda x: x][0]
+    return new_type(value)
+
+
+def legacy_flatten(metadata):
+    flattened = {
+        f"{doc_name}.{key}": value
+        for doc_name, doc in metadata.items()
+        for key, value in doc.items()
+    }
+    return {key: legacy_to_hdf_type(value) for key, value in flattened.items()}
+
+
+def legacy_write(metadata, nxentry):
+    """Write one field at a time, as write_metadata used to."""
+    md_group = new_group(nxentry["instrument/bluesky"], "metadata", "NXnote")
+    for key, value in legacy_flatten(metadata).items():
+        new_field(md_group, key, value)
+
+
+def time_write(write, metadata, backend: str) -> float:
+    fd = io.BytesIO()
+    if backend == "h5py":
+        with h5py.File(fd, mode="w") as h5file:
+            nxentry = new_entry(h5file, "entry")
+            t0 = time.perf_counter()
+            write(metadata, nxentry)
+            return time.perf_counter() - t0
+    with NexusIO(fd, mode="w") as nxfile:
+        nxentry = new_entry(nxfile.readfile(), "entry")
+        t0 = time.perf_counter()
+        write(metadata, nxentry)
+        return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--devices", type=int, nargs="*", default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    print(
+        f"{'devices':>8} {'fields':>7} {'step':<22} {'legacy (ms)':>12} {'new (ms)':>9}"
+    )
+    for num_devices in args.devices:
+        metadata = start_document(num_devices)
+        num_fields = len(flatten_metadata(metadata))
+        results = {
+            "flatten": [
+                min(timeit.repeat(lambda: func(metadata), number=1, repeat=args.repeat))
+                for func in [legacy_flatten, flatten_metadata]
+            ]
+        }
+        for backend in ["nexusformat", "h5py"]:
+            results[f"write ({backend})"] = [
+                time_write(func, metadata, backend)
+                for func in [legacy_write, write_metadata_fields]
+            ]
+        for step, (legacy, new) in results.items():
+            print(
+                f"{num_devices:>8} {num_fields:>7} {step:<22} "
+                f"{legacy * 1000:>12.1f} {new * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Compare the nexusformat and h5py backends for NeXus exports.
+
+Each backend runs in a fresh process so that peak memory use
+(``ru_maxrss``) is not polluted by the other backend. Since building
+the synthetic run also uses memory, the peak of allocations made
+during serialization (including numpy buffers) is also reported using
+:py:mod:`tracemalloc`. E.g.
+
+.. code-block:: bash
+
+    python benchmarks/nexus_backends.py --rows 1000 --frame-shape 8 4096
+
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from tiled.catalog import in_memory
+from tiled.client import Context, from_context
+from tiled.server.app import build_app
+
+from tiledspc.serialization.nexus import NEXUS_BACKENDS, serialize_nexus
+
+
+@contextmanager
+def build_run(
+    tree,
+    num_rows: int,
+    num_columns: int,
+    frame_shape: tuple[int, ...],
+    num_streams: int = 1,
+):
+    """Write a synthetic bluesky run into *tree*.
+
+    The first stream is named "primary", and any others
+    "stream1", "stream2", etc. Each gets *num_columns* scalar signals
+    and an external "detector" array with frames of *frame_shape*.
+
+    The run's metadata is yielded while the tiled app serving *tree*
+    is still running.
+
+    """
+    stream_names = ["primary"] + [f"stream{idx}" for idx in range(1, num_streams)]
+    with Context.from_app(build_app(tree)) as context:
+        client = from_context(context)
+        for stream_name in stream_names:
+            # Devices (and so field names) are not shared between streams
+            prefix = "" if stream_name == "primary" else f"{stream_name}_"
+            columns = [f"{prefix}signal{idx}" for idx in range(num_columns)]
+            detector = f"{prefix}detector"
+            data_keys = {
+                col: {
+                    "dtype": "number",
+                    "dtype_numpy": "<f8",
+                    "shape": [],
+                    "units": "V",
+                }
+                for col in columns
+            }
+            data_keys[detector] = {
+                "dtype": "array",
+                "dtype_numpy": "<u4",
+                "external": "STREAM:",
+                "shape": list(frame_shape),
+            }
+            hints = {
+                "signals": {"fields": columns[:1]},
+                "detector": {"fields": [detector]},
+            }
+            events = {}
+            for col in columns:
+                events[col] = np.random.default_rng().random(num_rows)
+                events[f"ts_{col}"] = np.linspace(0, num_rows, num=num_rows)
+            stream = client.create_container(
+                stream_name, metadata={"hints": hints, "data_keys": data_keys}
+            )
+            internal = stream.create_container("internal")
+            internal.write_dataframe(pd.DataFrame(events), key="events")
+            external = stream.create_container("external")
+            external.write_array(
+                np.ones((num_rows, *frame_shape), dtype="u4"), key=detector
+            )
+            config = stream.create_container("config")
+            config.write_dataframe(
+                pd.DataFrame({"energy-monochromator-d_spacing": [3.13]}), key="energy"
+            )
+        yield {
+            "start": {
+                "uid": "benchmark",
+                "time": 0.0,
+                "sample_name": "synthetic",
+                "edge": "Ni_K",
+            },
+            "stop": {"time": 1.0, "exit_status": "success"},
+        }
+
+
+def run_backend(backend: str, args, results):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tree = in_memory(writable_storage=tmpdir)
+        run = build_run(
+            tree,
+            num_rows=args.rows,
+            num_columns=args.columns,
+            frame_shape=tuple(args.frame_shape),
+        )
+        with run as metadata:
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            buff = asyncio.run(
+                serialize_nexus(
+                    tree, metadata=metadata, filter_for_access=None, backend=backend
+                )
+            )
+            wall_time = time.perf_counter() - t0
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results[backend] = {
+        "wall_time_s": wall_time,
+        "peak_rss_mb": rss_after / 1024,
+        "rss_growth_mb": (rss_after - rss_before) / 1024,
+        "traced_peak_mb": traced_peak / 1024**2,
+        "size_mb": len(buff) / 1024**2,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--frame-shape", type=int, nargs="*", default=[8, 4096])
+    parser.add_argument("--backends", nargs="*", default=NEXUS_BACKENDS)
+    args = parser.parse_args()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Manager() as manager:
+        results = manager.dict()
+        for backend in args.backends:
+            proc = ctx.Process(target=run_backend, args=(backend, args, results))
+            proc.start()
+            proc.join()
+        print(
+            f"{'backend':<12} {'time (s)':>9} {'peak RSS (MB)':>14} "
+            f"{'RSS growth (MB)':>16} {'traced peak (MB)':>17} {'size (MB)':>10}"
+        )
+        for backend, result in results.items():
+            print(
+                f"{backend:<12} {result['wall_time_s']:>9.2f} "
+                f"{result['peak_rss_mb']:>14.1f} {result['rss_growth_mb']:>16.1f} "
+                f"{result['traced_peak_mb']:>17.1f} {result['size_mb']:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
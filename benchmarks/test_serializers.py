@@ -0,0 +1,49 @@
+"""Benchmarks for exporting synthetic runs with each serializer.
+
+Wall time is measured by pytest-benchmark, and the peak resident
+memory and size of each export are saved alongside it (in
+``extra_info``). Compare against an earlier run to catch regressions,
+e.g.
+
+.. code-block:: bash
+
+    pytest benchmarks/ --benchmark-autosave
+    # ... make some changes ...
+    pytest benchmarks/ --benchmark-compare --benchmark-compare-fail=mean:10%
+
+"""
+
+import asyncio
+
+import pytest
+from conftest import PeakRSS
+
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.tsv import serialize_tsv, serialize_xdi
+
+SERIALIZERS = {
+    "nexus": serialize_nexus,
+    "tsv": serialize_tsv,
+    "xdi": serialize_xdi,
+}
+
+
+@pytest.mark.parametrize("serializer", SERIALIZERS.values(), ids=SERIALIZERS.keys())
+def test_serializer(benchmark, synthetic_run, serializer):
+    tree, metadata = synthetic_run
+    benchmark.group = serializer.__name__
+    peak_rss = PeakRSS()
+    sizes = []
+
+    def export():
+        with peak_rss:
+            buff = asyncio.run(
+                serializer(
+                    tree, metadata=metadata, filter_for_access=None, stream=False
+                )
+            )
+        sizes.append(len(buff))
+
+    benchmark(export)
+    benchmark.extra_info["peak_rss_mb"] = peak_rss.peak / 1024**2
+    benchmark.extra_info["size_mb"] = max(sizes) / 1024**2
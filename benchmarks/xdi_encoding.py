@@ -0,0 +1,85 @@
+"""Compare ways of encoding the data section of XDI/TSV exports.
+
+The original ``DataFrame.to_csv`` path (render to a ``StringIO``,
+concatenate onto the header text, then encode) is timed against
+:py:func:`tiledspc.serialization.tsv.build_xdi`. E.g.
+
+.. code-block:: bash
+
+    python benchmarks/xdi_encoding.py --rows 100000 1000000 10000000
+
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+import pandas as pd
+
+from tiledspc.serialization.tsv import build_xdi, data_keys, headers
+
+
+def synthetic_data(num_rows: int, num_columns: int):
+    columns = [f"signal{idx}" for idx in range(num_columns)]
+    rng = np.random.default_rng()
+    data = pd.DataFrame({col: rng.random(num_rows) for col in columns})
+    data.insert(0, "energy", np.linspace(8300, 8500, num=num_rows))
+    stream_metadata = {
+        "data_keys": {col: {"units": "V"} for col in data.columns},
+        "hints": {"signals": {"fields": list(data.columns)}},
+    }
+    return data, stream_metadata
+
+
+def to_csv_xdi(metadata, stream_metadata, data) -> bytes:
+    """The ``to_csv`` based encoder that :py:func:`build_xdi` replaced."""
+    data_keys_ = data_keys(stream_metadata)
+    xdi_text = ""
+    hdrs = headers(metadata, data_keys=data_keys_, d_spacing="None", strict=False)
+    xdi_text += "\n".join(hdrs) + "\n"
+    cols = "\t".join(data_keys_.keys())
+    xdi_text += f"# {cols}\n"
+    buffer = io.StringIO()
+    data.to_csv(buffer, sep="\t", header=False, columns=data_keys_.keys(), index=False)
+    buffer.seek(0)
+    xdi_text += buffer.read()
+    return xdi_text.encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="*", default=[10**5, 10**6])
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--precision", type=int, default=6)
+    args = parser.parse_args()
+    metadata = {"start": {"uid": "benchmark"}}
+    encoders = {
+        "to_csv": lambda md, data: to_csv_xdi(metadata, md, data),
+        "build_xdi": lambda md, data: build_xdi(
+            metadata, md, data, energy_config=None, strict=False
+        ),
+        f"build_xdi (%.{args.precision}g)": lambda md, data: build_xdi(
+            metadata,
+            md,
+            data,
+            energy_config=None,
+            strict=False,
+            precision=args.precision,
+        ),
+    }
+    print(f"{'rows':>10} {'encoder':<20} {'time (s)':>9} {'size (MB)':>10}")
+    for num_rows in args.rows:
+        data, stream_metadata = synthetic_data(num_rows, args.columns)
+        for name, encoder in encoders.items():
+            t0 = time.perf_counter()
+            output = encoder(stream_metadata, data)
+            wall_time = time.perf_counter() - t0
+            print(
+                f"{num_rows:>10} {name:<20} {wall_time:>9.2f} "
+                f"{len(output) / 1024**2:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
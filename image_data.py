@@ -2,14 +2,24 @@
 Read a variety of image file formats as input for tiled.
 """
 
+import functools
+import hashlib
+import json
+import math
+import os
 import pathlib
+import tempfile
 
+import dask.array
 import numpy
+import tifffile
 import yaml
-from PIL import Image
+import zarr
+from PIL import Image, ImageMode
 from PIL.TiffImagePlugin import IFDRational
 from tiled.adapters.array import ArrayAdapter
 from tiled.adapters.mapping import MapAdapter
+from tiled.structures.array import ArrayStructure
 from tiled.structures.core import Spec as TiledSpec
 from ignore_data import IGNORE_SPECIFICATION
 
@@ -31,6 +41,15 @@ MIMETYPES = """
 
 EMPTY_ARRAY = numpy.array([0, 0])
 IMAGE_FILE_SPECIFICATION = TiledSpec("image_file", version="1.0")
+# Approximate size (in bytes) of each block of decoded pixels
+CHUNK_BYTES = 4 * 2**20
+# Sidecar cache of computed image metadata, keyed by file path, mtime and size.
+# Relative paths are from where tiled is run (i.e. next to ./catalog.db).
+CACHE_DIR = pathlib.Path(os.environ.get("IMAGE_DATA_CACHE", ".image_cache"))
+# When to compute the extrema metadata (see ImageAdapter)
+EXTREMA_MODES = "eager lazy none".split()
+# Thumbnails are halved until their rows and columns fit in this many pixels
+THUMBNAIL_SIZE = 256
 
 
 def interpret_IFDRational(data):
@@ -60,7 +79,13 @@ def interpret_exif(image):
     return md
 
 
-def image_metadata(image):
+def image_metadata(image, exif=True):
+    """
+    Metadata from the header of an image.
+
+    Nothing here decodes the pixels. Set *exif* to false to skip
+    walking the EXIF tags.
+    """
     attrs = """
         bits
         filename
@@ -105,36 +130,554 @@ def image_metadata(image):
 
     # print(yaml.dump(md))
 
-    exif = interpret_exif(image)
-    if len(exif) > 0:
-        md["exif"] = exif
-
-    md["extrema"] = image.getextrema()
+    if exif:
+        tags = interpret_exif(image)
+        if len(tags) > 0:
+            md["exif"] = tags
 
     return md
 
 
-def read_image(filename, **kwargs):
+def image_array(image):
+    """
+    Decode the pixels of an image into a numpy array.
+
+    The array keeps the image's native data type (e.g. uint8 for RGB,
+    uint16 for 16-bit TIFF, float32 for mode "F"). Multi-band images
+    have the colors first: (bands, rows, columns).
+    """
+    pixels = numpy.asarray(image)  # one copy, straight from the decoder
+    if pixels.ndim > 2:
+        pixels = numpy.moveaxis(pixels, -1, 0)  # put the colors first
+    return pixels
+
+
+def tiff_layout(filename):
+    """
+    Describe how the pixels of a TIFF file are stored, from its header.
+
+    Only the file's first series of pages is used, so thumbnails and
+    reduced-resolution pages are left out. Returns a dict with the
+    number of frames (pages), and the axes (e.g. "YXS"), shape, data
+    type and strip (or tile) shape of each page. Pixels are found
+    either at ``offset``, if every page is stored uncompressed one
+    after another (so the whole stack can be memory-mapped), or from
+    the data ``segments`` (offsets and byte counts) of each page,
+    which get decoded like the ``keyframe`` page.
+    """
+    with tifffile.TiffFile(filename) as tif:
+        series = tif.series[0]
+        keyframe = series.keyframe
+        store = zarr.open(keyframe.aszarr(), mode="r")
+        layout = dict(
+            n_frames=len(series),
+            axes=keyframe.axes,
+            shape=store.shape,
+            dtype=numpy.dtype(store.dtype),
+            chunks=store.chunks,
+            byteorder=tif.byteorder,
+            keyframe=keyframe.index,
+            offset=series.dataoffset,
+            segments=None,
+        )
+        if series.dataoffset is None:
+            # Walk the pages once here, instead of for every frame read
+            layout["segments"] = [
+                (page.dataoffsets, page.databytecounts) for page in series.pages
+            ]
+        return layout
+
+
+def frames_mode(image):
+    """
+    The mode that every frame of an image gets decoded in.
+
+    PIL decodes the frames of an animated GIF after the first one in
+    RGB (or RGBA), so every frame gets converted to match.
+    """
+    if image.format == "GIF" and getattr(image, "n_frames", 1) > 1:
+        return "RGBA" if "transparency" in image.info else "RGB"
+    return image.mode
+
+
+class LazyImage:
+    """
+    Array-like view of an image file that decodes pixels when indexed.
+
+    Only the image header is read to learn the shape and data type.
+    TIFF files are decoded strip by strip (or tile by tile), so only
+    the rows that are asked for get decoded, and uncompressed TIFF
+    stacks are memory-mapped instead; other formats are decoded a
+    whole frame at a time. Like :func:`image_array`, the colors come
+    first.
+
+    Multi-frame images (e.g. TIFF stacks and animated GIFs) get an
+    extra first axis for the frames. Blocks always hold whole frames
+    (grouped into about :data:`CHUNK_BYTES`, if frames are small), and
+    only the TIFF frames that are asked for get decoded. Frames of
+    other formats (e.g. GIF) can only be decoded after the ones before
+    them, so a block's earlier frames get decoded too.
+    """
+
+    def __init__(self, filename, image):
+        self.filename = str(filename)
+        self.mode = frames_mode(image)
+        # Order of the file's axes that puts the colors first
+        self.order = None
+        layout = None
+        if image.format == "TIFF":
+            try:
+                layout = tiff_layout(filename)
+            except Exception:
+                # Fall back to decoding with PIL
+                layout = None
+        if layout is not None:
+            self.n_frames = layout["n_frames"]
+            self.dtype = layout["dtype"]
+            self.file_dtype = self.dtype.newbyteorder(layout["byteorder"])
+            self.page_shape = layout["shape"]
+            self.keyframe = layout["keyframe"]
+            self.offset = layout["offset"]
+            self.segments = layout["segments"]
+            axes = layout["axes"]
+            order = list(range(len(axes)))
+            if "S" in axes:
+                order.remove(axes.index("S"))
+                order.insert(0, axes.index("S"))
+            self.order = tuple(order)
+            frame_shape = tuple(self.page_shape[ax] for ax in self.order)
+            # Merge whole strips into blocks of about CHUNK_BYTES
+            row_axis = self.order.index(axes.index("Y"))
+            rows_per_strip = layout["chunks"][axes.index("Y")]
+            row_bytes = math.prod(frame_shape) // frame_shape[row_axis]
+            row_bytes *= self.dtype.itemsize
+            strips = max(CHUNK_BYTES // max(rows_per_strip * row_bytes, 1), 1)
+            frame_chunks = list(frame_shape)
+            frame_chunks[row_axis] = min(rows_per_strip * strips, frame_shape[row_axis])
+            frames_per_chunk = 1
+            if frame_chunks[row_axis] == frame_shape[row_axis]:
+                # Whole frames fit in a block, so group small ones together
+                frame_bytes = math.prod(frame_shape) * self.dtype.itemsize
+                frames_per_chunk = max(CHUNK_BYTES // max(frame_bytes, 1), 1)
+        else:
+            self.n_frames = getattr(image, "n_frames", 1)
+            rows, columns = reversed(image.size)
+            mode = ImageMode.getmode(self.mode)
+            bands = len(mode.bands)
+            frame_shape = (bands, rows, columns) if bands > 1 else (rows, columns)
+            self.dtype = numpy.dtype(mode.typestr)
+            frame_chunks = frame_shape
+            frame_bytes = math.prod(frame_shape) * self.dtype.itemsize
+            frames_per_chunk = max(CHUNK_BYTES // max(frame_bytes, 1), 1)
+        if self.n_frames > 1:
+            self.shape = (self.n_frames, *frame_shape)
+            self.chunks = (min(frames_per_chunk, self.n_frames), *frame_chunks)
+        else:
+            self.shape = tuple(frame_shape)
+            self.chunks = tuple(frame_chunks)
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        # A single frame, picked by its index
+        one_frame = self.n_frames == 1 or not isinstance(key[0], slice)
+        if self.n_frames == 1:
+            frames = [0]
+        elif one_frame:
+            frames = [range(self.n_frames)[key[0]]]
+            key = key[1:]
+        else:
+            frames = range(*key[0].indices(self.n_frames))
+            key = key[1:]
+        if len(frames) == 0:
+            empty_frame = numpy.empty(self.shape[1:], dtype=self.dtype)[key]
+            return empty_frame[numpy.newaxis][:0]
+        if self.order is None:
+            pixels = self.pil_frames(frames, key)
+        else:
+            pixels = self.tiff_frames(frames, key)
+        if one_frame:
+            return pixels[0]
+        return numpy.stack(pixels)
+
+    def pil_frames(self, frames, key):
+        """Decode whole *frames* of the image with PIL, then apply *key*."""
+        decoded = {}
+        with Image.open(self.filename) as image:
+            # Seeking forward only decodes the frames in between
+            for frame in sorted(set(frames)):
+                decoded[frame] = self.pil_frame(image, frame)[key]
+        return [decoded[frame] for frame in frames]
+
+    def pil_frame(self, image, frame):
+        """Decode one whole frame of the image with PIL."""
+        image.seek(frame)
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        return image_array(image)
+
+    def tiff_frames(self, frames, key):
+        """Decode the parts of TIFF pages (*frames*) selected by *key*."""
+        file_key = [None] * len(key)
+        for idx, ax in enumerate(self.order):
+            file_key[ax] = key[idx]
+        file_key = tuple(file_key)
+        if self.offset is not None:
+            # Uncompressed, so read just these bytes straight from the file
+            stack = numpy.memmap(
+                self.filename,
+                dtype=self.file_dtype,
+                mode="r",
+                offset=self.offset,
+                shape=(self.n_frames, *self.page_shape),
+            )
+            pages = [stack[frame][file_key] for frame in frames]
+        else:
+            whole = all(
+                isinstance(idx, slice) and idx.indices(size) == (0, size, 1)
+                for idx, size in zip(file_key, self.page_shape)
+            )
+            with tifffile.TiffFile(self.filename) as tif:
+                keyframe = tif.pages[self.keyframe]
+                pages = []
+                for frame in frames:
+                    page = self.tiff_frame(tif, keyframe, frame)
+                    if whole:
+                        pages.append(page.asarray())
+                    else:
+                        # Only the strips that overlap these rows get decoded
+                        pages.append(zarr.open(page.aszarr(), mode="r")[file_key])
+        return [
+            numpy.transpose(numpy.asarray(page, dtype=self.dtype), self.order)
+            for page in pages
+        ]
+
+    def tiff_frame(self, tif, keyframe, frame):
+        """One TIFF page, found from its recorded data segments."""
+        offsets, bytecounts = self.segments[frame]
+        page = tifffile.TiffFrame(
+            tif,
+            index=frame,
+            keyframe=keyframe,
+            dataoffsets=offsets,
+            databytecounts=bytecounts,
+        )
+        return page
+
+
+def lazy_image_array(filename, image):
+    """
+    A dask array of the pixels in an image file.
+
+    No pixels are decoded until part of the array is computed.
+    """
+    lazy = LazyImage(filename, image)
+    return dask.array.from_array(
+        lazy,
+        chunks=lazy.chunks,
+        name=False,
+        # Don't let dask read a sample to learn the data type
+        meta=numpy.empty((0,) * lazy.ndim, dtype=lazy.dtype),
+    )
+
+
+def cache_path(filename, kind, suffix=".json"):
+    """
+    Where the cached *kind* (e.g. "extrema") of an image file is kept.
+
+    The key includes the file's modification time and size, so a
+    changed file gets a new entry instead of stale metadata.
+    """
+    path = pathlib.Path(filename).resolve()
+    stat = path.stat()
+    key = f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return CACHE_DIR / f"{digest}.{kind}{suffix}"
+
+
+def load_cached(filename, kind, suffix=".json"):
+    """
+    The cached *kind* of data for an image file, or None.
+
+    Arrays (``suffix=".npy"``) are memory-mapped, not read in.
+    """
+    try:
+        path = cache_path(filename, kind, suffix)
+        if suffix == ".npy":
+            return numpy.load(path, mmap_mode="r")
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def partial_cache_file():
+    """
+    A new, empty file in the cache to write an entry into.
+
+    Entries are written to one of these and then renamed into place,
+    so readers never see a partial entry.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    return pathlib.Path(partial)
+
+
+def save_cached(filename, kind, value):
+    """Keep *value* in the sidecar cache as JSON, if it can be written."""
+    try:
+        path = cache_path(filename, kind)
+        partial = partial_cache_file()
+        with open(partial, "w") as f:
+            json.dump(value, f)
+        os.replace(partial, path)
+    except OSError:
+        pass  # e.g. read-only: it gets computed again next time
+
+
+def array_extrema(pixels, band_axis=None):
+    """
+    The (min, max) of the pixels, per band, like ``Image.getextrema()``.
+
+    Works on numpy and dask arrays alike: both reductions are computed
+    together, in one pass over the pixels.
+    """
+    axes = tuple(ax for ax in range(pixels.ndim) if ax != band_axis)
+    low, high = dask.array.compute(pixels.min(axis=axes), pixels.max(axis=axes))
+    if band_axis is None:
+        return [low.item(), high.item()]
+    return [[lo, hi] for lo, hi in zip(low.tolist(), high.tolist())]
+
+
+class ImageAdapter(ArrayAdapter):
+    """
+    The pixels of an image file, with extrema added to the metadata.
+
+    The extrema need every pixel decoded, so *extrema* sets when that
+    happens:
+
+    ``"eager"``
+        when the metadata is first asked for (e.g. at registration).
+    ``"lazy"`` (default)
+        when the whole array is first read; until then the metadata
+        has extrema only if they are already in the cache. A catalog
+        keeps the metadata from when each file was registered, so it
+        only serves these extrema after the files are registered
+        again (e.g. by a later ``tiled register`` of the same tree).
+    ``"none"``
+        never.
+
+    Either way, computed extrema are kept in a sidecar cache
+    (:data:`CACHE_DIR`), so each file only gets decoded for them once,
+    e.g. registering a tree again only decodes new or changed files.
+    """
+
+    def __init__(
+        self,
+        array,
+        structure,
+        *,
+        filename,
+        band_axis=None,
+        extrema="lazy",
+        metadata=None,
+        specs=None,
+        **kwargs,
+    ):
+        if extrema not in EXTREMA_MODES:
+            raise ValueError(f"extrema={extrema!r} is not one of {EXTREMA_MODES}")
+        super().__init__(array, structure, metadata=metadata, specs=specs, **kwargs)
+        self.filename = str(filename)
+        self.band_axis = band_axis
+        self.extrema_mode = extrema
+        self._extrema = None
+
+    def extrema(self, pixels=None):
+        """
+        The extrema of the image, from the cache if possible.
+
+        If *pixels* (the whole decoded array) is given, uncached extrema
+        are computed from it, otherwise they are only computed when
+        *extrema* is ``"eager"``.
+        """
+        if self.extrema_mode == "none":
+            return None
+        if self._extrema is None:
+            self._extrema = load_cached(self.filename, "extrema")
+        if self._extrema is None and (
+            pixels is not None or self.extrema_mode == "eager"
+        ):
+            source = self._array if pixels is None else pixels
+            self._extrema = array_extrema(source, band_axis=self.band_axis)
+            save_cached(self.filename, "extrema", self._extrema)
+        return self._extrema
+
+    def metadata(self):
+        md = super().metadata()
+        extrema = self.extrema()
+        if extrema is not None:
+            md = dict(md, extrema=extrema)
+        return md
+
+    def read(self, *args, **kwargs):
+        pixels = super().read(*args, **kwargs)
+        if self.extrema_mode == "lazy" and pixels.shape == self.structure().shape:
+            # Decode once, for both the extrema and the response
+            pixels = numpy.asarray(pixels)
+            self.extrema(pixels)
+        return pixels
+
+
+def downsample(pixels):
+    """
+    Halve the rows and columns (the last two axes) of a numpy array.
+
+    Each 2x2 block of pixels is averaged; an odd last row or column
+    is dropped. The data type is kept.
+    """
+    rows, columns = (n // 2 for n in pixels.shape[-2:])
+    pixels = pixels[..., : 2 * rows, : 2 * columns]
+    blocks = pixels.reshape(*pixels.shape[:-2], rows, 2, columns, 2)
+    means = blocks.mean(axis=(-3, -1))
+    if numpy.issubdtype(pixels.dtype, numpy.integer):
+        means = numpy.rint(means)
+    return means.astype(pixels.dtype)
+
+
+def pyramid_shapes(shape):
+    """
+    The shapes of each level of thumbnails for an array of *shape*.
+
+    Each level is half the size of the one before, down to the first
+    that fits in :data:`THUMBNAIL_SIZE`. Small images have no levels.
+    """
+    shapes = []
+    while max(shape[-2:]) > THUMBNAIL_SIZE and min(shape[-2:]) > 1:
+        shape = (*shape[:-2], shape[-2] // 2, shape[-1] // 2)
+        shapes.append(shape)
+    return shapes
+
+
+class ImagePyramid:
+    """
+    Downsampled copies of an image's pixels, cached on disk.
+
+    Each level is made from the one before it (level 1 from the
+    image itself) the first time it is asked for, and is saved in the
+    sidecar cache (:data:`CACHE_DIR`). Levels are written one frame
+    at a time into a memory-mapped ``.npy`` file, so only one frame
+    is in memory at once, even for long stacks. After that, levels
+    are memory-mapped from the cache.
+
+    *stacked* is true if the first axis of *pixels* holds frames.
+    """
+
+    def __init__(self, filename, pixels, stacked=False):
+        self.filename = str(filename)
+        self.pixels = pixels
+        self.stacked = stacked
+        self.shapes = pyramid_shapes(pixels.shape)
+
+    def level(self, level):
+        """The pixels of one *level* (starting at 1, for half size)."""
+        pixels = load_cached(self.filename, f"level{level}", ".npy")
+        if pixels is None:
+            pixels = self.build(level)
+        return pixels
+
+    def build(self, level):
+        """Make (and cache) one *level* of thumbnails."""
+        source = self.pixels if level == 1 else self.level(level - 1)
+        shape = self.shapes[level - 1]
+        partial = None
+        try:
+            path = cache_path(self.filename, f"level{level}", ".npy")
+            partial = partial_cache_file()
+            pixels = numpy.lib.format.open_memmap(
+                partial, mode="w+", dtype=source.dtype, shape=shape
+            )
+        except OSError:
+            # e.g. read-only: keep this level in memory instead
+            if partial is not None:
+                partial.unlink(missing_ok=True)
+            path = None
+            pixels = numpy.empty(shape, dtype=source.dtype)
+        try:
+            if self.stacked:
+                for frame in range(shape[0]):
+                    pixels[frame] = downsample(numpy.asarray(source[frame]))
+            else:
+                pixels[...] = downsample(numpy.asarray(source))
+        except BaseException:
+            if path is not None:
+                del pixels
+                partial.unlink(missing_ok=True)
+            raise
+        if path is None:
+            return pixels
+        pixels.flush()
+        del pixels
+        os.replace(partial, path)
+        return load_cached(self.filename, f"level{level}", ".npy")
+
+    def adapters(self):
+        """An array adapter for each level, keyed by level number."""
+        adapters = {}
+        for level, shape in enumerate(self.shapes, start=1):
+            pixels = dask.array.from_delayed(
+                dask.delayed(self.level, pure=True)(level),
+                shape=shape,
+                dtype=self.pixels.dtype,
+                meta=numpy.empty((0,) * len(shape), dtype=self.pixels.dtype),
+            )
+            adapters[str(level)] = ArrayAdapter.from_array(
+                pixels, metadata=dict(level=level, downsample=2**level)
+            )
+        return adapters
+
+
+def read_image(filename, exif=True, extrema="lazy", pyramid=False, **kwargs):
+    """
+    Read an image file as an array, for tiled.
+
+    *exif* and *extrema* set how much metadata to collect (see
+    :func:`image_metadata` and :class:`ImageAdapter`). With *pyramid*,
+    the file is read as a container instead: the full array is its
+    ``image`` child and downsampled levels (see :class:`ImagePyramid`)
+    are in ``thumbnails``, e.g. ``thumbnails/2`` is a quarter size,
+    for previews. Use :func:`image_reader` to choose these for a catalog.
+    """
     fn = pathlib.Path(filename).name
     try:
-        image = Image.open(filename)
-        md = image_metadata(image)
-
-        # # special cases
-        # if image.format == "AVIF":
-        #     pass
-
-        im = image.getdata()
-        pixels = list(im)  # 1-D array of int or tuple
-        shape = list(reversed(im.size))
-        if im.bands > 1:
-            shape.append(im.bands)
-        pixels = numpy.array(pixels).reshape(shape)
-        if len(shape) > 2:
-            pixels = numpy.moveaxis(pixels, -1, 0)  # put the colors first
-        return ArrayAdapter.from_array(
-            pixels, metadata=md, specs=[IMAGE_FILE_SPECIFICATION]
+        with Image.open(filename) as image:
+            md = image_metadata(image, exif=exif)
+
+            # # special cases
+            # if image.format == "AVIF":
+            #     pass
+
+            pixels = lazy_image_array(filename, image)
+            bands = len(ImageMode.getmode(frames_mode(image)).bands)
+        band_axis = None
+        if bands > 1:
+            band_axis = 1 if pixels.ndim > 3 else 0
+        adapter = ImageAdapter(
+            pixels,
+            ArrayStructure.from_array(pixels),
+            filename=filename,
+            band_axis=band_axis,
+            extrema=extrema,
+            metadata=md,
+            specs=[IMAGE_FILE_SPECIFICATION],
         )
+        if not pyramid:
+            return adapter
+        stacked = pixels.ndim > (2 if band_axis is None else 3)
+        pyramid = ImagePyramid(filename, pixels, stacked=stacked)
+        thumbnails = MapAdapter(pyramid.adapters())
+        return MapAdapter(dict(image=adapter, thumbnails=thumbnails), metadata=md)
 
     except Exception as exc:
         arrays = dict(
@@ -155,6 +698,26 @@ def read_image(filename, **kwargs):
         )
 
 
+def image_reader(exif=True, extrema="lazy", pyramid=False):
+    """
+    An image reader that collects this much metadata, for one catalog.
+
+    E.g. ``adapters_by_mimetype`` can name ``image_data:read_image_basic``
+    for a large image tree, to register files from their headers alone.
+    """
+    if extrema not in EXTREMA_MODES:
+        raise ValueError(f"extrema={extrema!r} is not one of {EXTREMA_MODES}")
+    return functools.partial(read_image, exif=exif, extrema=extrema, pyramid=pyramid)
+
+
+# Header metadata only: no EXIF tags and no extrema
+read_image_basic = image_reader(exif=False, extrema="none")
+# All the metadata, with extrema computed at registration (decodes every pixel)
+read_image_full = image_reader(extrema="eager")
+# Container of the image and its thumbnails, for browsing in web UIs
+read_image_pyramid = image_reader(pyramid=True)
+
+
 def main():
     testdir = ROOT / "data" / "usaxs" / "2021"
     for filepath in testdir.iterdir():
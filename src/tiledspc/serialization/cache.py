@@ -0,0 +1,237 @@
+"""A disk-backed cache of rendered exports.
+
+Finished runs do not change, so once a run has been exported in a
+given format, the resulting file can be served again as-is. Files are
+stored in a directory (which can be shared by several tiled workers)
+and the least-recently used files are evicted once the directory
+grows beyond its size limit.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import AsyncIterator, Mapping
+from pathlib import Path
+from typing import IO, Any
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.timing import record_cache_lookup, record_cache_size
+
+__all__ = ["ExportCache", "default_cache", "cache_chunks"]
+
+
+log = logging.getLogger(__name__)
+
+
+class ExportCache:
+    """Store rendered export files on disk, keyed by run and format.
+
+    Parameters
+    ==========
+    directory
+      Where to keep the cached files.
+    max_size
+      Total size (in bytes) of the cached files before the
+      least-recently used ones are removed.
+
+    """
+
+    suffix = ".export"
+
+    def __init__(self, directory: Path | str, max_size: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"<ExportCache directory='{self.directory}' max_size={self.max_size} "
+            f"hits={self.hits} misses={self.misses}>"
+        )
+
+    def key(
+        self,
+        metadata: Mapping[str, Mapping],
+        media_type: str,
+        options: Mapping[str, Any] = {},
+    ) -> str | None:
+        """Build the cache key for exporting a run.
+
+        Returns None for runs that are still in progress (no *stop*
+        document), since their contents may still change.
+
+        """
+        stop_doc = metadata.get("stop")
+        if not stop_doc:
+            return None
+        identity = {
+            "start": metadata["start"]["uid"],
+            "stop": stop_doc.get("uid"),
+            "media_type": media_type,
+            "options": options,
+        }
+        identity = json.dumps(identity, sort_keys=True, default=str)
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}{self.suffix}"
+
+    def open(self, key: str | None) -> IO[bytes] | None:
+        """Open the cached export for *key*, or None if it is not cached."""
+        if key is None:
+            return None
+        path = self.path(key)
+        try:
+            fd = open(path, mode="rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            record_cache_lookup(hit=False)
+            log.debug(f"Export cache miss: {key}. {self.stats()}")
+            return None
+        # Mark this file as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another worker since it was opened, but the
+            # open file can still be read
+            pass
+        with self._lock:
+            self.hits += 1
+        record_cache_lookup(hit=True)
+        log.debug(f"Export cache hit: {key}. {self.stats()}")
+        return fd
+
+    def read(self, key: str | None) -> bytes | None:
+        """The cached export for *key*, or None if it is not cached."""
+        fd = self.open(key)
+        if fd is None:
+            return None
+        with fd:
+            return fd.read()
+
+    def new_file(self) -> IO[bytes]:
+        """Create a temporary file in the cache directory for an export.
+
+        Once the export has been rendered into it, pass the file to
+        :py:meth:`commit` to cache it (a rename, not a copy), or to
+        :py:meth:`discard` if rendering failed.
+
+        """
+        # Other workers only ever see finished exports, since the
+        # temporary file does not have the cache's suffix
+        return tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        )
+
+    def commit(self, key: str, fd: IO[bytes]):
+        """Save the export rendered into *fd* (from :py:meth:`new_file`).
+
+        *fd* is rewound and left open so the caller can still send it
+        to the client. This touches the file system (including
+        :py:meth:`evict`), so call it off the event loop, e.g. with
+        :py:func:`asyncio.to_thread`.
+
+        """
+        fd.flush()
+        os.replace(fd.name, self.path(key))
+        fd.seek(0)
+        self.evict()
+
+    def discard(self, fd: IO[bytes]):
+        """Close and remove a file from :py:meth:`new_file` without caching it."""
+        fd.close()
+        Path(fd.name).unlink(missing_ok=True)
+
+    def store(self, key: str | None, fd: IO[bytes]):
+        """Save a copy of the contents of the open file *fd* under *key*.
+
+        *fd* is read from the beginning, and is left open so the
+        caller can still send it to the client. Exports rendered
+        with the cache in mind should use :py:meth:`new_file` instead,
+        to avoid the copy.
+
+        """
+        if key is None:
+            return
+        fd.seek(0)
+        tmp_fd = self.new_file()
+        try:
+            shutil.copyfileobj(fd, tmp_fd)
+            self.commit(key, tmp_fd)
+        except BaseException:
+            self.discard(tmp_fd)
+            raise
+        tmp_fd.close()
+        fd.seek(0)
+
+    def evict(self):
+        """Remove least-recently used exports until the cache fits."""
+        entries = []
+        for path in self.directory.glob(f"*{self.suffix}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Another worker already removed it
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            log.debug(f"Evicted export from cache: {path}")
+        record_cache_size(total_size)
+
+    def stats(self) -> dict[str, int]:
+        """Hit/miss counts for this cache since the server started."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_default_cache = None
+
+
+def default_cache() -> ExportCache | None:
+    """The export cache described by the settings, if one is enabled."""
+    global _default_cache
+    if settings.EXPORT_CACHE_DIR is None:
+        return None
+    directory = Path(settings.EXPORT_CACHE_DIR)
+    if _default_cache is None or _default_cache.directory != directory:
+        _default_cache = ExportCache(directory, max_size=settings.EXPORT_CACHE_SIZE)
+    return _default_cache
+
+
+async def cache_chunks(
+    chunks: AsyncIterator[bytes], cache: ExportCache | None, key: str | None
+) -> AsyncIterator[bytes]:
+    """Pass along *chunks* of an export, saving them to *cache* as well.
+
+    The export is only stored once every chunk has been sent, so
+    interrupted downloads never end up in the cache.
+
+    """
+    if cache is None or key is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    fd = cache.new_file()
+    try:
+        async for chunk in chunks:
+            fd.write(chunk)
+            yield chunk
+        await asyncio.to_thread(cache.commit, key, fd)
+    except BaseException:
+        cache.discard(fd)
+        raise
+    fd.close()
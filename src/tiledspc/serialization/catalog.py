@@ -0,0 +1,173 @@
+"""Helpers for reading bluesky runs out of the tiled catalog."""
+
+import asyncio
+from collections.abc import AsyncIterator, Iterable, Mapping
+from typing import Any
+
+from pandas import DataFrame
+from tiled.utils import SerializationError, ensure_awaitable
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.timing import nbytes, timed
+
+__all__ = [
+    "lookup",
+    "lookup_children",
+    "iter_children",
+    "asdict",
+    "read_table",
+    "iter_table",
+    "find_runs",
+]
+
+
+async def lookup(node, *segments: str):
+    """Fetch the node at the path *segments* below *node*.
+
+    Only the requested node is looked up, so the other children of
+    the containers along the way are never loaded. E.g.
+
+    .. code-block:: python
+
+        events = await lookup(run, "primary", "internal", "events")
+
+    Raises a ``KeyError`` if there is no such node.
+
+    """
+    with timed("lookup", path="/".join(segments)):
+        if hasattr(node, "lookup_adapter"):
+            return await node.lookup_adapter(list(segments))
+        # Adapters that are not backed by the catalog (e.g. MapAdapter)
+        for segment in segments:
+            node = node[segment]
+        return node
+
+
+async def lookup_children(node, keys: Iterable[str]) -> dict[str, Any]:
+    """Fetch the children of *node* named in *keys*, all at once.
+
+    Keys that do not exist are left out of the result.
+
+    """
+    keys = list(keys)
+
+    async def lookup_child(key):
+        try:
+            return await lookup(node, key)
+        except KeyError:
+            return None
+
+    children = await asyncio.gather(*(lookup_child(key) for key in keys))
+    return {key: child for key, child in zip(keys, children) if child is not None}
+
+
+async def iter_children(
+    node, page_size: int | None = None
+) -> AsyncIterator[tuple[str, Any]]:
+    """Yield ``(key, node)`` for every child of *node*, a page at a time.
+
+    Only *page_size* children (default:
+    ``settings.CATALOG_PAGE_SIZE``) are fetched from the catalog at
+    once, so large containers can be processed piece by piece.
+
+    """
+    if page_size is None:
+        page_size = settings.CATALOG_PAGE_SIZE
+    offset = 0
+    while True:
+        with timed("items_range", offset=offset):
+            page = await node.items_range(offset, page_size)
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            break
+        offset += len(page)
+
+
+async def asdict(node) -> dict[str, Any]:
+    """Convert a catalog node to a dictionary of its children.
+
+    Every child gets fetched, so prefer :py:func:`lookup` or
+    :py:func:`lookup_children` if only some are needed.
+
+    """
+    return {key: child async for key, child in iter_children(node)}
+
+
+async def read_table(node, columns: Iterable[str] | None = None) -> DataFrame:
+    """Read a table node, fetching only the given *columns*.
+
+    Columns that are not present in the table are ignored. If
+    *columns* is None, the whole table is read.
+
+    """
+    with timed("read_table") as span:
+        if columns is None:
+            table = await ensure_awaitable(node.read)
+        else:
+            available = node.structure().columns
+            columns = [col for col in columns if col in available]
+            table = await ensure_awaitable(node.read, fields=columns)
+        span.bytes_read = nbytes(table)
+    return table
+
+
+async def iter_table(
+    node, columns: Iterable[str] | None = None
+) -> AsyncIterator[DataFrame]:
+    """Read a table node one partition at a time.
+
+    Only one partition is held in memory at a time, so long tables
+    can be processed piece by piece. Columns that are not present in
+    the table are ignored. If *columns* is None, every column is read.
+
+    """
+    structure = node.structure()
+    if columns is not None:
+        columns = [col for col in columns if col in structure.columns]
+    for partition in range(structure.npartitions):
+        with timed("read_partition", partition=partition) as span:
+            table = await ensure_awaitable(
+                node.read_partition, partition, fields=columns
+            )
+            span.bytes_read = nbytes(table)
+        yield table
+
+
+async def find_runs(
+    node, metadata: Mapping[str, Any]
+) -> dict[str, tuple[Any, Mapping[str, Any]]]:
+    """Find the bluesky runs to export from *node*.
+
+    If *node* is itself a run (i.e. *metadata* has a start document),
+    it is the only run. Otherwise *node* is treated as a container of
+    runs (e.g. search results) and each child with a start document
+    is included.
+
+    Returns
+    =======
+    runs
+      ``(node, metadata)`` for each run, keyed by the run's uid.
+
+    Raises
+    ======
+    SerializationError
+      If there are no runs, or more than ``settings.MAX_BATCH_RUNS``.
+
+    """
+    if "start" in metadata:
+        return {metadata["start"]["uid"]: (node, metadata)}
+    runs = {}
+    with timed("find_runs"):
+        async for key, child in iter_children(node):
+            child_md = child.metadata()
+            if "start" not in child_md:
+                continue
+            if len(runs) >= settings.MAX_BATCH_RUNS:
+                raise SerializationError(
+                    f"Cannot export more than {settings.MAX_BATCH_RUNS} runs at once."
+                )
+            runs[child_md["start"]["uid"]] = (child, child_md)
+    if len(runs) == 0:
+        raise SerializationError("No runs found to export.")
+    return runs
@@ -1,30 +1,49 @@
+import asyncio
 import datetime as dt
-import io
+import functools
+import hashlib
+import itertools
 import json
 import logging
-from typing import IO, Mapping
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Executor
+from typing import IO, Any, Mapping
 
 import h5py
+import hdf5plugin
 import numpy as np
-from nexusformat.nexus import NeXusError, NXFile
-from nexusformat.nexus.tree import (
-    NXdata,
-    NXentry,
-    NXfield,
-    NXinstrument,
-    NXlinkfield,
-    NXnote,
-    NXroot,
-)
+from nexusformat.nexus import NeXusError, NXFile, nxgetcompression, nxgetmaxsize
+from nexusformat.nexus.tree import NXentry, NXfield, NXgroup, NXlinkfield, NXroot
+from pandas import DataFrame
 from tiled.catalog.adapter import CatalogContainerAdapter
-from tiled.utils import SerializationError
+from tiled.utils import SerializationError, ensure_awaitable
+
+try:
+    from tiled.ndslice import NDBlock
+except ImportError:
+    # Older versions of tiled use plain tuples for block indices
+    def NDBlock(*block):
+        return tuple(block)
+
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.cache import default_cache
+from tiledspc.serialization.catalog import (
+    asdict,
+    find_runs,
+    lookup,
+    lookup_children,
+    read_table,
+)
+from tiledspc.serialization.offload import file_writer, run_writer
+from tiledspc.serialization.streaming import file_view, iter_file, spooled_file
+from tiledspc.serialization.timing import measure_output, timed
 
 log = logging.getLogger(__name__)
 
 
-async def asdict(node):
-    """Convert a catalog node to a dictionary."""
-    return {key: val for key, val in await node.items_range(0, None)}
+MEDIA_TYPE = "application/x-nexus"
+NEXUS_BACKENDS = ["nexusformat", "h5py"]
 
 
 class NexusIO(NXFile):
@@ -58,11 +77,191 @@ class NexusIO(NXFile):
         pass
 
 
+@functools.singledispatch
+def new_group(parent, name: str, nx_class: str):
+    """Create a NeXus group of class *nx_class* inside *parent*.
+
+    *parent* can be either a nexusformat group or an h5py group, and
+    the new group will be of the same kind.
+
+    """
+    parent[name] = NXgroup(nxclass=nx_class)
+    return parent[name]
+
+
+@new_group.register
+def _(parent: h5py.Group, name: str, nx_class: str):
+    group = parent.create_group(name)
+    group.attrs["NX_class"] = nx_class
+    return group
+
+
+@functools.singledispatch
+def new_field(parent, name: str, value, **h5opts):
+    """Create a NeXus field holding *value* inside *parent*.
+
+    Extra keyword arguments (e.g. *chunks*, *compression*) are used
+    when creating the HDF5 dataset.
+
+    """
+    parent[name] = NXfield(value, **h5opts)
+    return parent[name]
+
+
+def default_h5opts(shape) -> dict:
+    """Dataset options that match what nexusformat uses by default.
+
+    Large fields get compressed, so that both NeXus backends produce
+    similar files.
+
+    """
+    if np.prod(shape, dtype=int) > nxgetmaxsize():
+        return {"chunks": True, "compression": nxgetcompression(), "shuffle": True}
+    return {}
+
+
+@new_field.register
+def _(parent: h5py.Group, name: str, value, **h5opts):
+    opts = {**default_h5opts(np.shape(value)), **h5opts}
+    return parent.create_dataset(name, data=value, **opts)
+
+
+@functools.singledispatch
+def new_empty_field(parent, name: str, shape, dtype, **h5opts):
+    """Create a NeXus field inside *parent* to be filled in later."""
+    parent[name] = NXfield(shape=shape, dtype=dtype, **h5opts)
+    return parent[name]
+
+
+@new_empty_field.register
+def _(parent: h5py.Group, name: str, shape, dtype, **h5opts):
+    opts = {**default_h5opts(shape), **h5opts}
+    return parent.create_dataset(name, shape=shape, dtype=dtype, **opts)
+
+
+# Dataset options for each compression filter, given a compression level
+COMPRESSION_FILTERS = {
+    "none": lambda level: {"compression": None, "shuffle": False},
+    "gzip": lambda level: {
+        "compression": "gzip",
+        "compression_opts": 4 if level is None else level,
+        "shuffle": True,
+    },
+    "lzf": lambda level: {"compression": "lzf", "shuffle": True},
+    "blosc": lambda level: dict(
+        hdf5plugin.Blosc(
+            cname="lz4",
+            clevel=5 if level is None else level,
+            shuffle=hdf5plugin.Blosc.SHUFFLE,
+        )
+    ),
+    "bitshuffle": lambda level: dict(hdf5plugin.Bitshuffle(cname="lz4")),
+    "lz4": lambda level: dict(hdf5plugin.LZ4()),
+    "zstd": lambda level: dict(hdf5plugin.Zstd(clevel=3 if level is None else level)),
+}
+# Filters that have no compression level to set
+UNLEVELED_FILTERS = {"none", "lzf", "bitshuffle", "lz4"}
+
+
+def compression_filters(compression: str | None, level: int | None = None):
+    """HDF5 dataset options for the compression filter named *compression*.
+
+    Returns None if *compression* is None, meaning the library
+    defaults should be used. Only ``"gzip"``, ``"blosc"`` and
+    ``"zstd"`` take a compression *level*; giving one for any other
+    filter is an error rather than being silently ignored.
+
+    """
+    if compression is None:
+        return None
+    try:
+        filters = COMPRESSION_FILTERS[compression.lower()]
+    except KeyError:
+        raise SerializationError(
+            f"Unknown compression '{compression}'. "
+            f"Options are {list(COMPRESSION_FILTERS.keys())}."
+        )
+    if level is not None and compression.lower() in UNLEVELED_FILTERS:
+        leveled = [
+            name for name in COMPRESSION_FILTERS if name not in UNLEVELED_FILTERS
+        ]
+        raise SerializationError(
+            f"Compression '{compression}' does not take a compression level. "
+            f"Levels are only used by {leveled}."
+        )
+    return filters(level)
+
+
+def chunk_shape(
+    shape: Sequence[int], itemsize: int, frame_ndim: int = 0
+) -> tuple[int, ...]:
+    """Pick HDF5 chunks for a dataset of per-event frames.
+
+    The last *frame_ndim* axes of *shape* hold one event's data (the
+    ``shape`` from its data key). Whole frames are grouped into chunks
+    of about :py:data:`settings.HDF5_CHUNK_BYTES`, only splitting up
+    individual frames if a single frame is larger than that.
+
+    """
+    target = settings.HDF5_CHUNK_BYTES
+    frame_ndim = min(frame_ndim, len(shape))
+    num_event_dims = len(shape) - frame_ndim
+    event_shape = [max(dim, 1) for dim in shape[:num_event_dims]]
+    frame_chunk = [max(dim, 1) for dim in shape[num_event_dims:]]
+    # Split up frames that are too big on their own
+    while np.prod(frame_chunk, dtype=int) * itemsize > target and max(frame_chunk) > 1:
+        axis = next(idx for idx, dim in enumerate(frame_chunk) if dim > 1)
+        frame_chunk[axis] = -(-frame_chunk[axis] // 2)
+    # Fill the rest of the chunk with events, fastest axis first
+    frames_per_chunk = max(target // (np.prod(frame_chunk, dtype=int) * itemsize), 1)
+    event_chunk = []
+    for dim in reversed(event_shape):
+        event_chunk.insert(0, int(min(dim, frames_per_chunk)))
+        frames_per_chunk = max(frames_per_chunk // dim, 1)
+    return tuple(event_chunk + frame_chunk)
+
+
+def dataset_options(shape, dtype, frame_ndim: int = 0, filters=None) -> dict:
+    """Chunking and compression options for one of a stream's datasets.
+
+    *filters* comes from :py:func:`compression_filters`. If it is None,
+    or the dataset is too small to be worth compressing, no options
+    are given and the defaults get used.
+
+    """
+    if filters is None or np.prod(shape, dtype=int) <= nxgetmaxsize():
+        return {}
+    chunks = chunk_shape(shape, np.dtype(dtype).itemsize, frame_ndim=frame_ndim)
+    return {**filters, "chunks": chunks}
+
+
+@functools.singledispatch
+def new_link(parent, name: str, target):
+    """Create a link inside *parent* pointing to the field *target*."""
+    parent[name] = NXlinkfield(target)
+    return parent[name]
+
+
+@new_link.register
+def _(parent: h5py.Group, name: str, target):
+    # Hard link with a "target" attribute, the same as nexusformat
+    parent[name] = target
+    target.attrs["target"] = target.name
+    return parent[name]
+
+
 async def write_run(
-    nxfile: NexusIO,
+    nxfile: NexusIO | NXroot | h5py.File,
     node: CatalogContainerAdapter,
     metadata: Mapping[str, Mapping | float | str | int],
-) -> NXroot:
+    filters: Mapping | None = None,
+    streams: Sequence[str] | None = None,
+    fields: Sequence[str] | None = None,
+    exclude_external: bool = False,
+    since: Mapping[str, int] | None = None,
+    since_time: float | None = None,
+    writer: Executor | None = None,
+) -> NXroot | h5py.File:
     """Write a run to the HDF file as a nexus-compatiable entry.
 
     *node* should be the container for this run. E.g.
@@ -72,6 +271,29 @@ async def write_run(
         uid = "7d1daf1d-60c7-4aa7-a668-d1cd97e5335f"
         write_stream(name=uid, node=client[uid])
 
+    If *nxfile* is a :py:class:`NexusIO` file (or the root of its
+    tree), the entry is built as a nexusformat tree. If *nxfile* is an
+    open ``h5py.File``, groups and datasets are written directly with
+    h5py instead.
+
+    *filters* are the HDF5 compression options for stream datasets
+    (see :py:func:`compression_filters`).
+
+    Only the streams named in *streams* and the data keys named in
+    *fields* are written (default: all of them), and external data keys
+    are left out if *exclude_external* is true. Data that are not
+    written are not read from the catalog either.
+
+    For incremental exports of runs still being acquired, *since* (the
+    row number to start from for each stream, as returned by
+    :py:func:`split_cursors`) or *since_time* (a timestamp) limits each
+    stream to newer rows; see :py:func:`write_stream_data`. Streams
+    missing from *since* are written from their first row.
+
+    If given, all writes to the file are done by *writer* (from
+    :py:func:`tiledspc.serialization.offload.file_writer`) instead of
+    on the event loop.
+
     Returns
     =======
     root
@@ -79,29 +301,73 @@ async def write_run(
 
     """
     name = metadata["start"]["uid"]
-    root = nxfile.readfile()
-    root.attrs["default"] = name
-    nxentry = NXentry()
-    root[name] = nxentry
-    # Create bluesky groups
-    nxentry["data"] = NXdata(date=None)
-    nxentry["instrument"] = NXinstrument()
-    nxentry["instrument/bluesky"] = NXnote(date=None)
-    bluesky_group = nxentry["instrument/bluesky"]
-    bluesky_group["streams"] = NXnote(date=None)
-    # Write stream data
-    await write_metadata(metadata, nxentry=nxentry)
-    for stream_name, stream_node in await node.items_range(0, None):
-        await write_stream(
-            name=stream_name,
-            node=stream_node,
-            nxentry=nxentry,
-            metadata=stream_node.metadata(),
+    with timed("write_run", uid=name):
+        if isinstance(nxfile, (h5py.Group, NXgroup)):
+            root = nxfile
+        else:
+            root = await run_writer(writer, nxfile.readfile)
+        nxentry = await run_writer(writer, new_entry, root, name)
+        await write_metadata(metadata, nxentry=nxentry, writer=writer)
+        limiter = new_limiter()
+        if streams is None:
+            stream_nodes = await asdict(node)
+        else:
+            # Only look up the requested streams
+            stream_nodes = await lookup_children(node, streams)
+            missing = [stream for stream in streams if stream not in stream_nodes]
+            if len(missing) > 0:
+                raise SerializationError(f"Could not find streams: {missing}")
+        # Decide which data keys to write for each stream
+        stream_mds = {
+            name: select_fields(
+                stream_node.metadata(), fields=fields, exclude_external=exclude_external
+            )
+            for name, stream_node in stream_nodes.items()
+        }
+        if fields is not None:
+            # Skip streams with nothing left to write
+            stream_mds = {
+                name: stream_md
+                for name, stream_md in stream_mds.items()
+                if len(stream_md["data_keys"]) > 0
+            }
+        # Fetch all the streams' data at once
+        loaded = await asyncio.gather(
+            *(
+                load_stream(
+                    stream_nodes[name],
+                    limiter=limiter,
+                    data_keys=stream_md["data_keys"],
+                )
+                for name, stream_md in stream_mds.items()
+            )
         )
+        # Write the data one stream at a time so links are named consistently
+        copies = []
+        for (stream_name, stream_md), (events, external) in zip(
+            stream_mds.items(), loaded
+        ):
+            with timed("write_stream_data", uid=name, stream=stream_name):
+                stream_group, stream_copies = await run_writer(
+                    writer,
+                    write_stream_data,
+                    name=stream_name,
+                    events=events,
+                    external=external,
+                    nxentry=nxentry,
+                    metadata=stream_md,
+                    filters=filters,
+                    since=None if since is None else since.get(stream_name, 0),
+                    since_time=since_time,
+                )
+            copies.extend(stream_copies)
+        # Copy the external arrays for all streams concurrently
+        await copy_arrays(copies, limiter=limiter, writer=writer)
     # Write attributes
     return root
 
 
+@functools.singledispatch
 def to_hdf_type(value):
     """Some objects cannot be stored as HDF5 types.
 
@@ -109,125 +375,497 @@ def to_hdf_type(value):
 
     Complex structures, like dictionaries, are converted to JSON.
 
+    Conversions are looked up by the value's type, so other types can
+    be added with ``to_hdf_type.register``.
+
     """
-    type_conversions = [
-        # (old => new)
-        (dt.datetime, str),
-        (dict, json.dumps),
-        (list, json.dumps),
-    ]
-    new_types = [new for old, new in type_conversions if isinstance(value, old)]
-    new_type = [*new_types, lambda x: x][0]
-    return new_type(value)
-
-
-async def write_metadata(metadata: dict[str], nxentry: NXentry):
-    """Write run-level metadata to the Nexus file."""
-    bluesky_group = nxentry["instrument/bluesky"]
-    md_group = NXnote(date=None)
-    bluesky_group["metadata"] = md_group
-    flattened = {
-        f"{doc_name}.{key}": value
+    return value
+
+
+# (old => new)
+to_hdf_type.register(dt.datetime, str)
+to_hdf_type.register(dict, json.dumps)
+to_hdf_type.register(list, json.dumps)
+
+
+def flatten_metadata(metadata: Mapping[str, Mapping]) -> dict[str, Any]:
+    """Flatten a run's documents into ``"{doc_name}.{key}"`` fields.
+
+    Values are converted with :py:func:`to_hdf_type` along the way.
+
+    """
+    return {
+        f"{doc_name}.{key}": to_hdf_type(value)
         for doc_name, doc in metadata.items()
         for key, value in doc.items()
     }
-    for key, value in flattened.items():
-        value = to_hdf_type(value)
-        md_group[key] = NXfield(value)
+
+
+@functools.singledispatch
+def new_fields(parent, name: str, nx_class: str, values: Mapping[str, Any]):
+    """Create a NeXus group holding a field for each item in *values*.
+
+    With nexusformat, the whole group is built in memory first and
+    then written to the file in one go, instead of one field at a
+    time.
+
+    """
+    parent[name] = NXgroup(
+        nxclass=nx_class,
+        entries={key: NXfield(value) for key, value in values.items()},
+    )
+    return parent[name]
+
+
+@new_fields.register
+def _(parent: h5py.Group, name: str, nx_class: str, values: Mapping[str, Any]):
+    group = new_group(parent, name, nx_class)
+    for key, value in values.items():
+        new_field(group, key, value)
+    return group
+
+
+def new_entry(root: NXroot | h5py.File, name: str) -> NXentry | h5py.Group:
+    """Create the NXentry group (and bluesky sub-groups) for a run."""
+    root.attrs["default"] = name
+    nxentry = new_group(root, name, "NXentry")
+    # Create bluesky groups
+    new_group(nxentry, "data", "NXdata")
+    new_group(nxentry, "instrument", "NXinstrument")
+    bluesky_group = new_group(nxentry, "instrument/bluesky", "NXnote")
+    new_group(bluesky_group, "streams", "NXnote")
+    return nxentry
+
+
+async def write_metadata(
+    metadata: dict[str],
+    nxentry: NXentry | h5py.Group,
+    writer: Executor | None = None,
+):
+    """Write run-level metadata to the Nexus file.
+
+    If given, the fields are written by *writer* instead of on the
+    event loop.
+
+    """
+    with timed("write_metadata"):
+        await run_writer(writer, write_metadata_fields, metadata, nxentry)
+
+
+def write_metadata_fields(metadata: dict[str], nxentry: NXentry | h5py.Group):
+    """Write the fields for run-level metadata into a NeXus entry."""
+    bluesky_group = nxentry["instrument/bluesky"]
+    flattened = flatten_metadata(metadata)
+    md_group = new_fields(bluesky_group, "metadata", "NXnote", flattened)
     # Create additional convenient links
-    if "start.sample_name" in md_group.keys():
-        nxentry["sample_name"] = NXlinkfield(md_group["start.sample_name"])
-    if "start.scan_name" in md_group.keys():
-        nxentry["scan_name"] = NXlinkfield(md_group["start.scan_name"])
-    if "start.plan_name" in md_group.keys():
-        nxentry["plan_name"] = NXlinkfield(md_group["start.plan_name"])
-        bluesky_group["plan_name"] = NXlinkfield(md_group["start.plan_name"])
-    if "start.uid" in md_group.keys():
-        bluesky_group["uid"] = NXlinkfield(md_group["start.uid"])
-        nxentry["entry_identifier"] = NXlinkfield(md_group["start.uid"])
+    if "start.sample_name" in flattened:
+        new_link(nxentry, "sample_name", md_group["start.sample_name"])
+    if "start.scan_name" in flattened:
+        new_link(nxentry, "scan_name", md_group["start.scan_name"])
+    if "start.plan_name" in flattened:
+        new_link(nxentry, "plan_name", md_group["start.plan_name"])
+        new_link(bluesky_group, "plan_name", md_group["start.plan_name"])
+    if "start.uid" in flattened:
+        new_link(bluesky_group, "uid", md_group["start.uid"])
+        new_link(nxentry, "entry_identifier", md_group["start.uid"])
     for phase in ["start", "stop"]:
-        if f"{phase}.time" in flattened.keys():
+        if f"{phase}.time" in flattened:
             timestamp = dt.datetime.fromtimestamp(flattened[f"{phase}.time"])
-            nxentry[f"{phase}_time"] = NXfield(timestamp.astimezone().isoformat())
-    if "start.time" in flattened.keys() and "stop.time" in flattened.keys():
-        nxentry["duration"] = NXfield(flattened["stop.time"] - flattened["start.time"])
+            new_field(nxentry, f"{phase}_time", timestamp.astimezone().isoformat())
+    if "start.time" in flattened and "stop.time" in flattened:
+        new_field(nxentry, "duration", flattened["stop.time"] - flattened["start.time"])
 
 
-async def write_stream(
-    name: str, node, nxentry: NXentry, metadata: Mapping[str, dict] = {}
+def block_slices(chunks: tuple[tuple[int, ...], ...]) -> Iterator[tuple]:
+    """Iterate over the blocks of an array's chunk structure.
+
+    Yields
+    ======
+    block
+      The index of the block, suitable for ``read_block()``.
+    slices
+      The slices locating this block in the full array.
+
+    """
+    edges = [np.cumsum([0, *dim_chunks]) for dim_chunks in chunks]
+    block_ranges = [range(len(dim_chunks)) for dim_chunks in chunks]
+    for block in itertools.product(*block_ranges):
+        slices = tuple(
+            slice(int(dim_edges[idx]), int(dim_edges[idx + 1]))
+            for dim_edges, idx in zip(edges, block)
+        )
+        yield NDBlock(*block), slices
+
+
+def empty_field(
+    parent, name: str, node, start: int = 0, **h5opts
+) -> NXfield | h5py.Dataset:
+    """Create an unfilled NeXus field matching a tiled array node.
+
+    Unless *chunks* is given, the HDF5 dataset is chunked to match the
+    blocks of *node* so that each block can be written independently.
+
+    If *start* is given, the field only has room for the rows of
+    *node* from *start* onwards.
+
+    """
+    structure = node.structure()
+    shape = tuple(structure.shape)
+    if len(shape) > 0 and start > 0:
+        shape = (max(shape[0] - start, 0), *shape[1:])
+    if "chunks" not in h5opts:
+        chunks = tuple(
+            min(max(dim_chunks, default=0), size)
+            for dim_chunks, size in zip(structure.chunks, shape)
+        )
+        if len(shape) == 0 or 0 in chunks:
+            # HDF5 cannot chunk scalars or empty datasets
+            chunks = None
+        h5opts["chunks"] = chunks
+    return new_empty_field(
+        parent,
+        name,
+        shape=shape,
+        dtype=structure.data_type.to_numpy_dtype(),
+        **h5opts,
+    )
+
+
+def new_limiter() -> asyncio.Semaphore:
+    """Create a semaphore to limit how many reads happen at once."""
+    return asyncio.Semaphore(settings.MAX_CONCURRENT_READS)
+
+
+async def limited(limiter: asyncio.Semaphore, func, *args, **kwargs):
+    """Call (and await) *func* once *limiter* has room."""
+    async with limiter:
+        return await ensure_awaitable(func, *args, **kwargs)
+
+
+def write_block(field: NXfield | h5py.Dataset, slices: tuple, data):
+    """Write one block of data into its place in *field*."""
+    if len(slices) == 0:
+        field[...] = data
+    else:
+        field[slices] = data
+
+
+async def write_blocks(
+    node,
+    field: NXfield | h5py.Dataset,
+    limiter: asyncio.Semaphore | None = None,
+    writer: Executor | None = None,
 ):
-    """Write a stream to the HDF file as a nexus-compatiable entry.
+    """Copy the data from a tiled array node into *field* block-by-block.
 
-    *node* should be the container for this stream. E.g.
+    Only one block of *node* is held in memory at a time. *field*
+    should already be part of a file-backed tree (e.g. from
+    :py:func:`empty_field`) so that each block is written straight to
+    the HDF5 dataset.
 
-    .. code-block:: python
+    If *field* has fewer rows than *node* (e.g. for incremental
+    exports), only the trailing rows of *node* are copied, and blocks
+    before them are not read at all.
 
-        write_stream(name="primary", node=run["primary"])
+    If given, *limiter* is held while each block is being read, and
+    blocks are written (and compressed) by *writer*.
 
-    Parameters
-    ==========
-    name
-      The name for the new HDF5 NXdata group.
-    node
-      The tiled container for this stream.
-    parent
-      The HDF5 group/file to add this stream's group to.
-    metadata
-      Descriptions of the individual datasets to create and hint.
+    Returns
+    =======
+    num_bytes
+      How much data was read from *node*.
+
+    """
+    if limiter is None:
+        limiter = new_limiter()
+    structure = node.structure()
+    start = structure.shape[0] - field.shape[0] if len(structure.shape) > 0 else 0
+    num_bytes = 0
+    for block, slices in block_slices(structure.chunks):
+        if start > 0:
+            rows = slices[0]
+            if rows.stop <= start:
+                continue
+            skip = max(start - rows.start, 0)
+            data = await limited(limiter, node.read_block, block)
+            data = data[skip:]
+            slices = (slice(rows.start + skip - start, rows.stop - start), *slices[1:])
+        else:
+            data = await limited(limiter, node.read_block, block)
+        num_bytes += data.nbytes
+        await run_writer(writer, write_block, field, slices, data)
+    return num_bytes
+
+
+async def copy_arrays(
+    copies: Sequence[tuple[Any, NXfield | h5py.Dataset]],
+    limiter: asyncio.Semaphore | None = None,
+    writer: Executor | None = None,
+):
+    """Copy several tiled array nodes into their NeXus fields at once.
+
+    *copies* holds ``(node, field)`` pairs, as returned by
+    :py:func:`write_stream_data`. Blocks are read concurrently
+    (bounded by *limiter*), but only one write is ever in progress:
+    writes happen either between awaits, or one after another on the
+    single *writer* thread.
+
+    """
+    if limiter is None:
+        limiter = new_limiter()
+    with timed("copy_arrays", num_arrays=len(copies)) as span:
+        num_bytes = await asyncio.gather(
+            *(
+                write_blocks(node, field, limiter=limiter, writer=writer)
+                for node, field in copies
+            )
+        )
+        span.bytes_read = sum(num_bytes)
+
+
+def select_fields(
+    metadata: Mapping[str, Any],
+    fields: Sequence[str] | None = None,
+    exclude_external: bool = False,
+) -> dict[str, Any]:
+    """Restrict a stream's metadata to the data keys that will be exported.
+
+    Returns a copy of *metadata* with only the data keys listed in
+    *fields* (or all of them if *fields* is None), minus any external
+    data keys if *exclude_external* is true. Hints for data keys that
+    were left out are dropped too.
+
+    """
+    all_keys = metadata.get("data_keys", {})
+    data_keys = {
+        key: desc
+        for key, desc in all_keys.items()
+        if (fields is None or key in fields)
+        and not (exclude_external and "external" in desc)
+    }
+    hints = {
+        device: {
+            **dev_hints,
+            "fields": [
+                field
+                for field in dev_hints.get("fields", [])
+                # Unknown fields are kept so that they still raise an error
+                if field in data_keys or field not in all_keys
+            ],
+        }
+        for device, dev_hints in metadata.get("hints", {}).items()
+    }
+    return {**metadata, "data_keys": data_keys, "hints": hints}
+
+
+async def load_stream(
+    node,
+    limiter: asyncio.Semaphore | None = None,
+    data_keys: Mapping[str, dict] | None = None,
+) -> tuple[DataFrame | None, dict | None]:
+    """Fetch the data for one stream from the catalog.
+
+    The internal events table and the external container are fetched
+    concurrently. External arrays themselves are not read; that
+    happens block-by-block in :py:func:`write_blocks`.
+
+    If *data_keys* is given, only the events columns (and timestamps)
+    for these keys are read, and only the external arrays for these
+    keys are looked up.
+
+    Returns
+    =======
+    events
+      The table of internal event data, or None if the stream has no
+      internal data (or none of it was asked for).
+    external
+      The nodes for this stream's external arrays, keyed by name, or
+      None if the stream has no external data.
+
+    """
+    if limiter is None:
+        limiter = new_limiter()
+    if data_keys is None:
+        columns = None
+        external_keys = None
+    else:
+        internal_keys = [
+            key for key, desc in data_keys.items() if "external" not in desc
+        ]
+        columns = [*internal_keys, *(f"ts_{key}" for key in internal_keys)]
+        external_keys = [key for key, desc in data_keys.items() if "external" in desc]
+
+    async def load_events():
+        if columns is not None and len(columns) == 0:
+            return None
+        try:
+            events = await limited(limiter, lookup, node, "internal", "events")
+        except KeyError:
+            # We don't have an internal dataset for some reason
+            return None
+        return await limited(limiter, read_table, events, columns)
+
+    async def load_external():
+        if external_keys is not None and len(external_keys) == 0:
+            return None
+        try:
+            container = await limited(limiter, lookup, node, "external")
+        except KeyError:
+            return None
+        if external_keys is None:
+            return await limited(limiter, asdict, container)
+        return await limited(limiter, lookup_children, container, external_keys)
+
+    return tuple(await asyncio.gather(load_events(), load_external()))
+
+
+def first_row(
+    events: DataFrame | None,
+    since: int | None = None,
+    since_time: float | None = None,
+) -> int:
+    """Decide which event row an incremental export starts from.
+
+    *since* is a row number, while *since_time* is a timestamp: rows
+    with any timestamp newer than *since_time* are included.
+
+    """
+    if since_time is None:
+        return since or 0
+    ts_columns = [] if events is None else [c for c in events if c.startswith("ts_")]
+    if len(ts_columns) == 0:
+        raise SerializationError("Cannot export by timestamp without event timestamps.")
+    row_times = events[ts_columns].max(axis=1).values
+    (newer,) = np.nonzero(row_times > since_time)
+    return int(newer[0]) if len(newer) > 0 else len(events)
+
+
+class SharedArrays:
+    """Keep track of arrays that have already been written to the file.
+
+    Bluesky timestamps are often identical for every column of a
+    device, so the arrays are compared by a hash of their contents
+    (and then checked element-by-element) to find repeats that can be
+    linked to instead of written again.
+
+    """
+
+    def __init__(self):
+        self._arrays = {}
+
+    @staticmethod
+    def _digest(array: np.ndarray) -> tuple:
+        array = np.ascontiguousarray(array)
+        content_hash = hashlib.blake2b(array.view(np.uint8)).digest()
+        return (array.dtype.str, array.shape, content_hash)
+
+    def find(self, array: np.ndarray):
+        """The value stored for an array equal to *array*, or None."""
+        try:
+            known_array, value = self._arrays[self._digest(array)]
+        except KeyError:
+            return None
+        if not np.array_equal(known_array, array):
+            return None
+        return value
+
+    def add(self, array: np.ndarray, value):
+        """Remember that *array* was written, along with *value*."""
+        self._arrays.setdefault(self._digest(array), (array, value))
+
+
+def write_stream_data(
+    name: str,
+    events: DataFrame | None,
+    external: Mapping | None,
+    nxentry: NXentry | h5py.Group,
+    metadata: Mapping[str, dict] = {},
+    filters: Mapping | None = None,
+    since: int | None = None,
+    since_time: float | None = None,
+):
+    """Write the already-loaded data for a stream into the NeXus entry.
+
+    External arrays are created empty, and are returned so they can
+    be filled in later with :py:func:`copy_arrays`. Large datasets are
+    chunked and compressed according to *filters*.
+
+    Columns with identical timestamps share a single pair of
+    ``EPOCH``/``time`` datasets, which the other columns link to.
+
+    If *since* (a row number) or *since_time* (a timestamp) is given,
+    only newer rows are written. The stream group then gets a
+    ``next_row`` attribute (and ``last_time`` if timestamps are
+    available) to use as the cursor for the next incremental export.
 
     Returns
     =======
     grp
       The HDF5 group used to hold this stream's data.
+    copies
+      ``(node, field)`` pairs for the external arrays still to be
+      copied.
 
     """
-    stream_group = NXnote(date=None)
-    nxentry[f"instrument/bluesky/streams/{name}"] = stream_group
-    # Make sure we have access to these data
-    containers = await asdict(node)
-    try:
-        internal = await asdict(containers["internal"])
-        events = await internal["events"].read()
-    except KeyError:
-        # We don't have an internal dataset for some reason
-        events = None
-    try:
-        external = await asdict(containers["external"])
-    except KeyError as exc:
-        external = None
+    stream_group = new_group(nxentry, f"instrument/bluesky/streams/{name}", "NXnote")
+    incremental = since is not None or since_time is not None
+    start = first_row(events, since=since, since_time=since_time)
+    time_fields = SharedArrays()
+    copies = []
     # Add individual data columns
     for col_name, desc in metadata["data_keys"].items():
-        nxdata = NXdata()
-        stream_group[col_name] = nxdata
+        nxdata = new_group(stream_group, col_name, "NXdata")
         if "external" in desc:
             if external is None:
                 raise SerializationError(
                     f"No external container available for {col_name}"
                 )
-            # Load and save external dataset from disk
-            data = await external[col_name].read()
-            nxdata["value"] = NXfield(data)
+            # External dataset gets copied from disk one block at a time
+            array_node = external[col_name]
+            structure = array_node.structure()
+            shape = (max(structure.shape[0] - start, 0), *structure.shape[1:])
+            opts = dataset_options(
+                shape,
+                structure.data_type.to_numpy_dtype(),
+                frame_ndim=len(desc.get("shape", [])),
+                filters=filters,
+            )
+            field = empty_field(nxdata, "value", array_node, start=start, **opts)
+            copies.append((array_node, field))
         else:
             # Save internal dataset
             try:
-                nxdata["value"] = NXfield(events[col_name].values)
-            except KeyError:
+                values = events[col_name].values[start:]
+            except (KeyError, TypeError):
                 raise SerializationError(
                     f"Could not find internal dataset '{col_name}'"
                 )
+            opts = dataset_options(values.shape, values.dtype, filters=filters)
+            new_field(nxdata, "value", values, **opts)
             if "units" in desc.keys():
                 nxdata["value"].attrs["units"] = desc["units"]
             nxdata.attrs["signal"] = "value"
             try:
-                times = events[f"ts_{col_name}"].values
+                all_times = events[f"ts_{col_name}"].values
             except KeyError:
                 log.error(
                     f"Could not find timestamps for internal dataset '{col_name}'"
                 )
             else:
-                nxdata["EPOCH"] = NXfield(times)
-                nxdata["time"] = times - np.min(times)
-                nxdata["time"].attrs["units"] = "s"
+                shared = time_fields.find(all_times)
+                if shared is not None:
+                    # Same timestamps as an earlier column, so link to them
+                    epoch_field, time_field = shared
+                    new_link(nxdata, "EPOCH", epoch_field)
+                    new_link(nxdata, "time", time_field)
+                else:
+                    # Keep relative times consistent between incremental exports
+                    times = all_times[start:]
+                    opts = dataset_options(times.shape, times.dtype, filters=filters)
+                    new_field(nxdata, "EPOCH", times, **opts)
+                    new_field(nxdata, "time", times - np.min(all_times), **opts)
+                    nxdata["time"].attrs["units"] = "s"
+                    time_fields.add(all_times, (nxdata["EPOCH"], nxdata["time"]))
                 nxdata.attrs["axes"] = "time"
     # Add links to the main NXdata group
     if name == "baseline":
@@ -242,29 +880,283 @@ async def write_stream(
             link_name = field if field not in root_nxdata.keys() else f"field_{name}"
             # Write the link
             try:
-                root_nxdata[link_name] = NXlinkfield(stream_group[field]["value"])
-            except NeXusError:
+                new_link(root_nxdata, link_name, stream_group[field]["value"])
+            except (NeXusError, KeyError):
                 raise SerializationError(
                     f"Could not link hinted '{name}' field: '{field}'"
                 )
+    # Save the cursor for the next incremental export
+    if incremental:
+        if events is not None:
+            stream_group.attrs["next_row"] = len(events)
+            ts_columns = [col for col in events if col.startswith("ts_")]
+            if len(events) > 0 and len(ts_columns) > 0:
+                stream_group.attrs["last_time"] = events[ts_columns].max().max()
+        elif len(copies) > 0:
+            stream_group.attrs["next_row"] = copies[0][0].structure().shape[0]
+    return stream_group, copies
+
+
+async def write_stream(
+    name: str,
+    node,
+    nxentry: NXentry | h5py.Group,
+    metadata: Mapping[str, dict] = {},
+    filters: Mapping | None = None,
+):
+    """Write a stream to the HDF file as a nexus-compatiable entry.
+
+    *node* should be the container for this stream. E.g.
+
+    .. code-block:: python
+
+        write_stream(name="primary", node=run["primary"])
+
+    Parameters
+    ==========
+    name
+      The name for the new HDF5 NXdata group.
+    node
+      The tiled container for this stream.
+    parent
+      The HDF5 group/file to add this stream's group to.
+    metadata
+      Descriptions of the individual datasets to create and hint.
+    filters
+      HDF5 compression options, from :py:func:`compression_filters`.
+
+    Returns
+    =======
+    grp
+      The HDF5 group used to hold this stream's data.
+
+    """
+    limiter = new_limiter()
+    with timed("write_stream", stream=name):
+        events, external = await load_stream(
+            node, limiter=limiter, data_keys=metadata.get("data_keys")
+        )
+        with timed("write_stream_data", stream=name):
+            stream_group, copies = write_stream_data(
+                name=name,
+                events=events,
+                external=external,
+                nxentry=nxentry,
+                metadata=metadata,
+                filters=filters,
+            )
+        await copy_arrays(copies, limiter=limiter)
     return stream_group
 
 
-async def serialize_nexus(node, metadata, filter_for_access):
+def split_names(names: str | Sequence[str] | None) -> list[str] | None:
+    """Turn a comma-separated string of names into a list."""
+    if names is None:
+        return None
+    if isinstance(names, str):
+        names = names.split(",")
+    return [name.strip() for name in names if name.strip()]
+
+
+def split_cursors(
+    since: int | str | Mapping[str, int] | None,
+    streams: Sequence[str] | None = None,
+) -> dict[str, int] | None:
+    """Turn an incremental export's *since* into a row number per stream.
+
+    Each stream has its own ``next_row`` cursor, so *since* is either
+    a mapping (e.g. ``{"primary": 100, "baseline": 2}``) or the same as
+    a comma-separated string (e.g. ``"primary:100,baseline:2"``). A
+    single row number is only accepted if *streams* names exactly one
+    stream.
+
+    """
+    if since is None:
+        return None
+    try:
+        if isinstance(since, str) and ":" in since:
+            since = dict(cursor.split(":", 1) for cursor in split_names(since))
+        if isinstance(since, Mapping):
+            return {stream.strip(): int(row) for stream, row in since.items()}
+    except ValueError:
+        raise SerializationError(f"Invalid row numbers for *since*: {since}")
+    if streams is None or len(streams) != 1:
+        raise SerializationError(
+            "Give *since* for each stream (e.g. 'primary:100,baseline:2'), "
+            "or export a single stream."
+        )
+    try:
+        return {streams[0]: int(since)}
+    except ValueError:
+        raise SerializationError(f"Invalid row number for *since*: {since}")
+
+
+async def write_runs(
+    root: NXroot | h5py.File,
+    runs: Mapping[str, tuple[CatalogContainerAdapter, Mapping]],
+    **kwargs,
+):
+    """Write several runs into the same file, each as its own NXentry.
+
+    *runs* holds ``(node, metadata)`` for each run, as returned by
+    :py:func:`tiledspc.serialization.catalog.find_runs`. Up to
+    ``settings.MAX_CONCURRENT_RUNS`` runs are read at once. Extra
+    keyword arguments are passed on to :py:func:`write_run`.
+
+    """
+    limiter = asyncio.Semaphore(settings.MAX_CONCURRENT_RUNS)
+
+    async def write_one(node, metadata):
+        async with limiter:
+            await write_run(nxfile=root, node=node, metadata=metadata, **kwargs)
+
+    await asyncio.gather(*(write_one(node, md) for node, md in runs.values()))
+    # Runs finish in any order, so make the first one the default
+    if len(runs) > 0:
+        root.attrs["default"] = next(iter(runs.keys()))
+
+
+async def write_nexus(fd: IO[bytes], node, metadata, backend: str, **kwargs):
+    """Write the NeXus file for a run (or container of runs) into *fd*.
+
+    Extra keyword arguments are passed on to :py:func:`write_run`.
+
+    """
+    runs = await find_runs(node, metadata)
+    with file_writer() as writer:
+        if backend == "h5py":
+            with h5py.File(fd, mode="w") as h5file:
+                await write_runs(h5file, runs, writer=writer, **kwargs)
+        else:
+            with NexusIO(fd, mode="w") as nxfile:
+                # Write data entries to the nexus file
+                tree = await run_writer(writer, nxfile.readfile)
+                await write_runs(tree, runs, writer=writer, **kwargs)
+                with timed("write_file"):
+                    await run_writer(writer, nxfile.writefile, tree)
+                nxfile.close()
+
+
+async def serialize_nexus(
+    node,
+    metadata,
+    filter_for_access,
+    *,
+    stream: bool | None = None,
+    chunk_size: int | None = None,
+    backend: str | None = None,
+    compression: str | None = None,
+    compression_level: int | None = None,
+    streams: str | Sequence[str] | None = None,
+    fields: str | Sequence[str] | None = None,
+    exclude_external: bool = False,
+    since: int | str | Mapping[str, int] | None = None,
+    since_time: float | None = None,
+):
     """Encode everything below this node as HDF5.
 
-    Assumes that *node* is a BlueskyRun.
+    *node* can be a BlueskyRun, or a container of runs (e.g. search
+    results) in which case each run gets its own NXentry in the file.
 
     Follows the NeXuS XAS spectroscopy definition."
 
+    The file is built in a spooled temporary file, so at most
+    *chunk_size* bytes are held in memory before it rolls over to
+    disk. If *stream* is true, the result is an async iterator of
+    *chunk_size* byte blocks that tiled will send as a streaming
+    response; otherwise the whole file is returned as a
+    ``memoryview`` of the spooled (or cached) file, without copying
+    it. Both default to the values in :py:mod:`tiledspc.serialization.settings`.
+
+    *backend* chooses how the HDF5 file gets written: ``"nexusformat"``
+    builds a nexusformat tree, while ``"h5py"`` writes the same layout
+    directly with h5py.
+
+    *compression* names the HDF5 filter used for large datasets (e.g.
+    ``"gzip"``, ``"lzf"``, ``"blosc"``, ``"bitshuffle"``, or
+    ``"none"``) with an optional *compression_level* (only for
+    ``"gzip"``, ``"blosc"`` and ``"zstd"``). If not given,
+    nexusformat's default compression is used.
+
+    *streams* and *fields* limit the export to the given streams and
+    data keys, either as lists or comma-separated strings (e.g.
+    ``fields="energy,It-net_current"``). External data keys are left
+    out if *exclude_external* is true.
+
+    For runs that are still being acquired, *since* (the event row
+    number for each stream, e.g. ``"primary:100,baseline:2"``) or
+    *since_time* (a timestamp) gives an incremental export with only
+    the newer rows. Each stream group's ``next_row`` and ``last_time``
+    attributes hold the cursor for the next request. A plain row
+    number can be given for *since* when only one stream is exported.
+
+    If an export cache is configured, finished runs are served from
+    (and saved to) the cache instead of being rebuilt every time.
+
     """
-    buff = io.BytesIO()
-    root_node = node
-    # MSG = "Metadata contains types or structure that does not fit into HDF5."
-
-    with NexusIO(buff, mode="w") as nxfile:
-        # Write data entry to the nexus file
-        tree = await write_run(nxfile=nxfile, node=node, metadata=metadata)
-        nxfile.writefile(tree)
-        nxfile.close()
-    return buff.getbuffer()
+    if stream is None:
+        stream = settings.STREAM_EXPORTS
+    if backend is None:
+        backend = settings.NEXUS_BACKEND
+    if backend not in NEXUS_BACKENDS:
+        raise SerializationError(
+            f"Unknown NeXus backend '{backend}'. Options are {NEXUS_BACKENDS}."
+        )
+    if compression is None:
+        compression = settings.NEXUS_COMPRESSION
+    if compression_level is None and str(compression).lower() not in UNLEVELED_FILTERS:
+        # The default level only applies to filters that use one
+        compression_level = settings.NEXUS_COMPRESSION_LEVEL
+    if since is not None and since_time is not None:
+        raise SerializationError("Only one of *since* and *since_time* can be given.")
+    filters = compression_filters(compression, compression_level)
+    streams = split_names(streams)
+    fields = split_names(fields)
+    since = split_cursors(since, streams=streams)
+    cache = default_cache()
+    cache_key = None
+    if cache is not None:
+        options = {
+            "backend": backend,
+            "compression": compression,
+            "compression_level": compression_level,
+            "streams": streams,
+            "fields": fields,
+            "exclude_external": exclude_external,
+            "since": since,
+            "since_time": since_time,
+        }
+        cache_key = cache.key(metadata, MEDIA_TYPE, options=options)
+        fd = cache.open(cache_key)
+    else:
+        fd = None
+    if fd is None:
+        # Finished runs are rendered straight into the cache directory
+        if cache_key is not None:
+            fd = cache.new_file()
+        else:
+            fd = spooled_file(chunk_size)
+        try:
+            await write_nexus(
+                fd,
+                node=node,
+                metadata=metadata,
+                backend=backend,
+                filters=filters,
+                streams=streams,
+                fields=fields,
+                exclude_external=exclude_external,
+                since=since,
+                since_time=since_time,
+            )
+            if cache_key is not None:
+                await asyncio.to_thread(cache.commit, cache_key, fd)
+        except BaseException:
+            if cache_key is not None:
+                cache.discard(fd)
+            else:
+                fd.close()
+            raise
+    if stream:
+        return measure_output(iter_file(fd, chunk_size), MEDIA_TYPE)
+    return measure_output(file_view(fd), MEDIA_TYPE)
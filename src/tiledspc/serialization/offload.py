@@ -0,0 +1,94 @@
+"""Run CPU-heavy encoding off the event loop.
+
+Serializers are coroutines, so any encoding done directly inside them
+blocks every other request handled by the same tiled worker. Work
+handed to :py:func:`run_encoder` runs in a thread or process pool
+instead (see ``settings.ENCODER_POOL``), leaving only I/O on the
+event loop.
+
+"""
+
+import asyncio
+import functools
+import multiprocessing
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from tiledspc.serialization import settings
+
+__all__ = ["ENCODER_POOLS", "run_encoder", "file_writer", "run_writer"]
+
+
+ENCODER_POOLS = ["thread", "process", "none"]
+
+
+_executors = {}
+
+
+def encoder_executor(pool: str) -> Executor | None:
+    """The shared executor for the encoder pool named *pool*.
+
+    Returns None if encoding should happen on the event loop.
+
+    """
+    if pool not in ENCODER_POOLS:
+        raise ValueError(f"Unknown encoder pool '{pool}'. Options are {ENCODER_POOLS}.")
+    if pool == "none":
+        return None
+    if pool not in _executors:
+        if pool == "process":
+            executor = ProcessPoolExecutor(
+                max_workers=settings.ENCODER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            executor = ThreadPoolExecutor(
+                max_workers=settings.ENCODER_WORKERS, thread_name_prefix="encoder"
+            )
+        _executors[pool] = executor
+    return _executors[pool]
+
+
+async def run_encoder(func: Callable, *args, pool: str | None = None, **kwargs):
+    """Call *func* in the encoder pool and wait for the result.
+
+    *pool* defaults to ``settings.ENCODER_POOL``. For the process pool,
+    *func* and its arguments must be picklable, so pass plain NumPy
+    arrays rather than data frames where possible.
+
+    """
+    if pool is None:
+        pool = settings.ENCODER_POOL
+    executor = encoder_executor(pool)
+    if executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+@contextmanager
+def file_writer():
+    """A thread for doing all the writes to one HDF5 file.
+
+    Since there is only one thread, writes happen one at a time and in
+    the order they were submitted, but off the event loop. Yields None
+    if ``settings.ENCODER_POOL`` is "none", in which case
+    :py:func:`run_writer` writes on the event loop.
+
+    """
+    if settings.ENCODER_POOL == "none":
+        yield None
+        return
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hdf5-writer") as writer:
+        yield writer
+
+
+async def run_writer(writer: Executor | None, func: Callable, *args, **kwargs):
+    """Call *func* using the file *writer* and wait for the result."""
+    if writer is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(writer, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,267 @@
+"""Render exports of finished runs ahead of time.
+
+Big runs can take minutes to export, so instead of making the first
+person to download a run wait, exports can be rendered in the
+background as soon as a run gets its stop document. Rendered exports
+are saved to the export cache (see
+:py:mod:`tiledspc.serialization.cache`), and the serializers then
+send them straight from there.
+
+This runs alongside the tiled server, pointed at the same catalog
+database and cache directory. E.g.
+
+.. code-block:: bash
+
+    export TILEDSPC_EXPORT_CACHE_DIR=/var/cache/tiledspc
+    # Render new runs as they finish
+    tiledspc-precompute watch postgresql+asyncpg://user@db.example.com/catalog
+    # Render runs that finished before the watcher was started
+    tiledspc-precompute backfill postgresql+asyncpg://user@db.example.com/catalog
+
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+from collections.abc import AsyncIterator, Callable, Sequence
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from tiled.catalog import from_uri
+from tiled.utils import SerializationError
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.catalog import iter_children
+from tiledspc.serialization.nexus import MEDIA_TYPE as NEXUS_MEDIA_TYPE
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.tsv import XDI_MEDIA_TYPE, serialize_xdi
+
+__all__ = [
+    "render_exports",
+    "iter_finished_runs",
+    "find_finished_runs",
+    "precompute",
+    "main",
+]
+
+
+log = logging.getLogger(__name__)
+
+
+# The exports to render for each run, keyed by media type. Runs that
+# cannot be exported in a format (e.g. XDI without energy
+# configuration) are skipped for that format
+EXPORTERS = {
+    NEXUS_MEDIA_TYPE: serialize_nexus,
+    XDI_MEDIA_TYPE: serialize_xdi,
+}
+
+
+async def render_exports(tree, uid: str) -> list[str]:
+    """Render the exports for one run into the export cache.
+
+    Exports are rendered with the default options, so that they match
+    what the serializers look for when a download is requested.
+
+    Returns
+    =======
+    media_types
+      The export formats that were rendered for this run.
+
+    """
+    node = await tree.lookup_adapter([uid])
+    metadata = node.metadata()
+    rendered = []
+    for media_type, serializer in EXPORTERS.items():
+        try:
+            await serializer(node, metadata, None, stream=False)
+        except SerializationError as exc:
+            log.info(f"Skipping {media_type} export for {uid}: {exc}")
+        else:
+            rendered.append(media_type)
+    return rendered
+
+
+async def iter_finished_runs(tree, limit: int | None = None) -> AsyncIterator[str]:
+    """Yield the runs in *tree* that have a stop document, newest first.
+
+    Only the *limit* most recently created runs are checked (default:
+    all of them). Runs are fetched from the catalog a page at a time.
+
+    """
+    page_size = settings.CATALOG_PAGE_SIZE
+    if limit is not None:
+        page_size = max(min(page_size, limit), 1)
+    checked = 0
+    async for key, node in iter_children(tree.sort([("", -1)]), page_size=page_size):
+        if node.metadata().get("stop"):
+            yield key
+        checked += 1
+        if limit is not None and checked >= limit:
+            break
+
+
+async def find_finished_runs(tree, limit: int | None = None) -> list[str]:
+    """Find runs in *tree* that have a stop document, newest first.
+
+    Only the *limit* most recently created runs are checked.
+
+    """
+    return [uid async for uid in iter_finished_runs(tree, limit=limit)]
+
+
+async def watch_runs(
+    tree, interval: float, limit: int | None = None
+) -> AsyncIterator[str]:
+    """Yield the uids of runs as they get their stop documents.
+
+    Each check only looks at the *limit* most recently created runs
+    (default: ``settings.PRECOMPUTE_WATCH_LIMIT``), so it stays cheap
+    however big the catalog gets. Runs that are already finished when
+    watching starts are not included; use :py:func:`find_finished_runs`
+    for those.
+
+    """
+    if limit is None:
+        limit = settings.PRECOMPUTE_WATCH_LIMIT
+    seen = set(await find_finished_runs(tree, limit=limit))
+    while True:
+        await asyncio.sleep(interval)
+        finished = await find_finished_runs(tree, limit=limit)
+        for uid in finished:
+            if uid not in seen:
+                yield uid
+        # Older runs have dropped out of the window, so forget them
+        seen = set(finished)
+
+
+async def precompute(
+    uids: AsyncIterator[str],
+    render: Callable[[str], list[str]],
+    executor: Executor | None = None,
+    workers: int | None = None,
+    queue_size: int | None = None,
+):
+    """Render exports for each run in *uids* using *executor*.
+
+    Runs wait in a queue of at most *queue_size* uids; once it is full,
+    no more runs are taken from *uids* until a worker frees up. Up to
+    *workers* runs are rendered at once by calling *render* (e.g.
+    :py:func:`render_run`) in *executor*. *workers* and *queue_size*
+    default to the values in :py:mod:`tiledspc.serialization.settings`.
+
+    """
+    if workers is None:
+        workers = settings.PRECOMPUTE_WORKERS
+    if queue_size is None:
+        queue_size = settings.PRECOMPUTE_QUEUE_SIZE
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            try:
+                media_types = await loop.run_in_executor(executor, render, uid)
+            except Exception:
+                log.exception(f"Could not render exports for {uid}")
+            else:
+                log.info(f"Rendered exports for {uid}: {media_types}")
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        async for uid in uids:
+            await queue.put(uid)
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# State for each worker process, set up by init_worker()
+_worker_tree = None
+_worker_loop = None
+
+
+def init_worker(uri: str, readable_storage: Sequence[str], cache_dir: str):
+    """Connect a worker process to the catalog and export cache."""
+    global _worker_tree, _worker_loop
+    settings.EXPORT_CACHE_DIR = cache_dir
+    _worker_tree = from_uri(uri, readable_storage=readable_storage)
+    # The catalog's database connections belong to one event loop, so
+    # keep using the same loop for every run
+    _worker_loop = asyncio.new_event_loop()
+
+
+def render_run(uid: str) -> list[str]:
+    """Render the exports for one run inside a worker process."""
+    return _worker_loop.run_until_complete(render_exports(_worker_tree, uid))
+
+
+async def run(args):
+    tree = from_uri(args.uri, readable_storage=args.readable_storage)
+    if args.command == "watch":
+        uids = watch_runs(tree, interval=args.interval, limit=args.limit)
+    else:
+
+        uids = iter_finished_runs(tree, limit=args.limit)
+    executor = ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.uri, args.readable_storage, settings.EXPORT_CACHE_DIR),
+    )
+    with executor:
+        await precompute(
+            uids,
+            render=render_run,
+            executor=executor,
+            workers=args.workers,
+            queue_size=args.queue_size,
+        )
+
+
+def main(argv: Sequence[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "command",
+        choices=["watch", "backfill"],
+        help="Render runs as they finish, or render runs that already finished.",
+    )
+    parser.add_argument("uri", help="Database URI for the tiled catalog.")
+    parser.add_argument(
+        "--readable-storage",
+        action="append",
+        default=[],
+        help="Directories the catalog's external data can be read from.",
+    )
+    parser.add_argument("--workers", type=int, default=settings.PRECOMPUTE_WORKERS)
+    parser.add_argument(
+        "--queue-size", type=int, default=settings.PRECOMPUTE_QUEUE_SIZE
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10.0,
+        help="Seconds between checks for newly finished runs.",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help=(
+            "Only check this many of the most recent runs (default: "
+            f"{settings.PRECOMPUTE_WATCH_LIMIT} when watching, all when backfilling)."
+        ),
+    )
+    args = parser.parse_args(argv)
+    if settings.EXPORT_CACHE_DIR is None:
+        parser.error("TILEDSPC_EXPORT_CACHE_DIR must be set to store exports.")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
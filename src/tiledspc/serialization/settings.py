@@ -0,0 +1,127 @@
+"""Server-side settings for the tiledspc serializers.
+
+Values are read from environment variables, so they can be set
+alongside ``BLUESKY_DB`` before starting the tiled server. E.g.
+
+.. code-block:: bash
+
+    export TILEDSPC_STREAM_EXPORTS=1
+    export TILEDSPC_CHUNK_SIZE=4194304
+
+Serializers look these up when they are called, so changing a value
+here (e.g. with ``monkeypatch`` in the tests) takes effect on the next
+request.
+
+"""
+
+import os
+
+__all__ = [
+    "STREAM_EXPORTS",
+    "CHUNK_SIZE",
+    "NEXUS_BACKEND",
+    "MAX_CONCURRENT_READS",
+    "EXPORT_CACHE_DIR",
+    "EXPORT_CACHE_SIZE",
+    "NEXUS_COMPRESSION",
+    "NEXUS_COMPRESSION_LEVEL",
+    "HDF5_CHUNK_BYTES",
+    "XDI_PRECISION",
+    "MAX_CONCURRENT_RUNS",
+    "MAX_BATCH_RUNS",
+    "PRECOMPUTE_WORKERS",
+    "PRECOMPUTE_QUEUE_SIZE",
+    "PRECOMPUTE_WATCH_LIMIT",
+    "ENCODER_POOL",
+    "ENCODER_WORKERS",
+    "EXPORT_METRICS",
+    "CATALOG_PAGE_SIZE",
+]
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """Interpret an environment variable as a true/false flag."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ["1", "true", "yes", "on"]
+
+
+def env_int(name: str, default: int | None) -> int | None:
+    """Interpret an environment variable as an integer."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(value)
+
+
+# Return exports as an async iterator of byte chunks instead of a
+# single buffer
+STREAM_EXPORTS = env_bool("TILEDSPC_STREAM_EXPORTS", False)
+
+# Size (in bytes) of each chunk sent to the client, and the amount of
+# a spooled export file that is held in memory before rolling over to
+# disk
+CHUNK_SIZE = env_int("TILEDSPC_CHUNK_SIZE", 2**20)
+
+# Library used to write NeXus files: "nexusformat" or "h5py"
+NEXUS_BACKEND = os.environ.get("TILEDSPC_NEXUS_BACKEND", "nexusformat")
+
+# How many catalog reads (tables, containers, array blocks) a single
+# export may have in flight at once
+MAX_CONCURRENT_READS = env_int("TILEDSPC_MAX_CONCURRENT_READS", 8)
+
+# Directory for caching rendered exports of finished runs. The cache is
+# disabled if this is not set
+EXPORT_CACHE_DIR = os.environ.get("TILEDSPC_EXPORT_CACHE_DIR")
+
+# Total size (in bytes) of the export cache before old files get evicted
+EXPORT_CACHE_SIZE = env_int("TILEDSPC_EXPORT_CACHE_SIZE", 10 * 2**30)
+
+# HDF5 compression filter for large NeXus datasets: "none", "gzip",
+# "lzf", "blosc", "bitshuffle", "lz4" or "zstd". If not set,
+# nexusformat's default (gzip) is used. The level is only used by the
+# "gzip", "blosc" and "zstd" filters
+NEXUS_COMPRESSION = os.environ.get("TILEDSPC_NEXUS_COMPRESSION")
+NEXUS_COMPRESSION_LEVEL = env_int("TILEDSPC_NEXUS_COMPRESSION_LEVEL", None)
+
+# Approximate size (in bytes) of each HDF5 chunk when compressing
+# NeXus datasets
+HDF5_CHUNK_BYTES = env_int("TILEDSPC_HDF5_CHUNK_BYTES", 2**20)
+
+# Significant digits for floating-point data in XDI/TSV exports. If not
+# set, the shortest representation that round-trips is used
+XDI_PRECISION = env_int("TILEDSPC_XDI_PRECISION", None)
+
+# How many runs a batch export (e.g. of search results) reads at once
+MAX_CONCURRENT_RUNS = env_int("TILEDSPC_MAX_CONCURRENT_RUNS", 4)
+
+# The most runs one batch export can hold, so a broad search cannot
+# tie up a worker building a huge file
+MAX_BATCH_RUNS = env_int("TILEDSPC_MAX_BATCH_RUNS", 100)
+
+# Worker processes used to render exports ahead of time, and how many
+# runs can wait in line for them (see tiledspc.serialization.precompute)
+PRECOMPUTE_WORKERS = env_int("TILEDSPC_PRECOMPUTE_WORKERS", 2)
+PRECOMPUTE_QUEUE_SIZE = env_int("TILEDSPC_PRECOMPUTE_QUEUE_SIZE", 100)
+# How many of the most recent runs get checked for stop documents each
+# time the precompute watcher polls the catalog
+PRECOMPUTE_WATCH_LIMIT = env_int("TILEDSPC_PRECOMPUTE_WATCH_LIMIT", 100)
+
+# Where CPU-heavy encoding runs so it does not stall the event loop:
+# "thread", "process" or "none" (on the event loop itself). HDF5 files
+# cannot be shared between processes, so NeXus exports use a writer
+# thread unless this is "none"
+ENCODER_POOL = os.environ.get("TILEDSPC_ENCODER_POOL", "thread")
+
+# Size of the encoder pool. If not set, the executor's default is used
+ENCODER_WORKERS = env_int("TILEDSPC_ENCODER_WORKERS", None)
+
+# Record how long each stage of an export takes (and how much data it
+# reads) as Prometheus metrics. Timings are always logged at the DEBUG
+# level (see tiledspc.serialization.timing)
+EXPORT_METRICS = env_bool("TILEDSPC_EXPORT_METRICS", False)
+
+# How many children of a container are fetched from the catalog at
+# once when every child is needed (e.g. all the runs in a search)
+CATALOG_PAGE_SIZE = env_int("TILEDSPC_CATALOG_PAGE_SIZE", 100)
@@ -0,0 +1,71 @@
+"""Helpers for sending serialized exports to the client in pieces."""
+
+import io
+import mmap
+import os
+import tempfile
+from collections.abc import AsyncIterator
+from typing import IO
+
+from tiledspc.serialization import settings
+
+__all__ = ["spooled_file", "iter_file", "file_view"]
+
+
+def spooled_file(chunk_size: int | None = None) -> IO[bytes]:
+    """Create a temporary file to write an export into.
+
+    Up to *chunk_size* bytes are held in memory, after which the file
+    is rolled over to disk.
+
+    """
+    if chunk_size is None:
+        chunk_size = settings.CHUNK_SIZE
+    return tempfile.SpooledTemporaryFile(max_size=chunk_size, mode="w+b")
+
+
+async def iter_file(
+    fd: IO[bytes], chunk_size: int | None = None
+) -> AsyncIterator[bytes]:
+    """Yield the contents of *fd* in blocks of at most *chunk_size* bytes.
+
+    The file is read from the beginning, and is closed once it has
+    been exhausted (or the client goes away).
+
+    """
+    if chunk_size is None:
+        chunk_size = settings.CHUNK_SIZE
+    try:
+        fd.seek(0)
+        while chunk := fd.read(chunk_size):
+            yield chunk
+    finally:
+        fd.close()
+
+
+def file_view(fd: IO[bytes]) -> memoryview:
+    """The contents of *fd* as a buffer, without copying them.
+
+    An export that is still held in memory is handed over as the
+    file's own buffer, and one that has rolled over to disk
+    (or comes from the export cache) is memory-mapped. Either way,
+    the response body shares memory with the file instead of needing
+    a second, full-size ``bytes`` object.
+
+    *fd* is closed, since neither the buffer nor the mapping depend on
+    it staying open.
+
+    """
+    fd.flush()
+    # SpooledTemporaryFile keeps the real file object in ``_file``,
+    # and its ``fileno()`` would force an in-memory file out to disk
+    raw = getattr(fd, "_file", fd)
+    with fd:
+        if isinstance(raw, io.BytesIO):
+            # BytesIO hands over its own bytes object (trimmed in place)
+            # rather than a copy, as long as no views of it exist
+            return memoryview(raw.getvalue())
+        if os.fstat(raw.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return memoryview(b"")
+        return memoryview(mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,183 @@
+"""Timing for the individual stages of an export.
+
+Each stage (reading from the catalog, building the NeXus tree,
+encoding text, etc.) is wrapped in :py:func:`timed`, which logs how
+long it took as a DEBUG record on this module's logger. The records
+carry the stage name, duration and byte counts as attributes, so a
+structured log formatter can pick them up. E.g. to see them:
+
+.. code-block:: python
+
+    logging.getLogger("tiledspc.serialization.timing").setLevel(logging.DEBUG)
+
+If ``settings.EXPORT_METRICS`` is true (and ``prometheus_client`` is
+installed), the same spans also feed Prometheus metrics, which tiled
+serves alongside its own at ``/api/v1/metrics``. So do the export
+cache's hits, misses and size, which are shared by all of tiled's
+workers, unlike
+:py:meth:`tiledspc.serialization.cache.ExportCache.stats`.
+
+"""
+
+import logging
+import time
+from collections.abc import AsyncIterable, AsyncIterator, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from tiledspc.serialization import settings
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+__all__ = [
+    "Span",
+    "timed",
+    "record_output",
+    "count_output",
+    "measure_output",
+    "nbytes",
+    "record_cache_lookup",
+    "record_cache_size",
+]
+
+log = logging.getLogger(__name__)
+
+
+if prometheus_client is not None:
+    STAGE_DURATION = prometheus_client.Histogram(
+        "tiledspc_export_stage_duration_seconds",
+        "time spent in each stage of exporting a run",
+        ["stage"],
+    )
+    BYTES_READ = prometheus_client.Counter(
+        "tiledspc_export_read_bytes",
+        "bytes of data read from the catalog while exporting runs",
+        ["stage"],
+    )
+    BYTES_PRODUCED = prometheus_client.Counter(
+        "tiledspc_export_produced_bytes",
+        "bytes of exported files sent to clients",
+        ["media_type"],
+    )
+    CACHE_HITS = prometheus_client.Counter(
+        "tiledspc_export_cache_hits",
+        "exports served from the export cache",
+    )
+    CACHE_MISSES = prometheus_client.Counter(
+        "tiledspc_export_cache_misses",
+        "exports that were not found in the export cache",
+    )
+    CACHE_SIZE = prometheus_client.Gauge(
+        "tiledspc_export_cache_size_bytes",
+        "total size of the files in the export cache",
+        multiprocess_mode="max",
+    )
+
+
+def metrics_enabled() -> bool:
+    return settings.EXPORT_METRICS and prometheus_client is not None
+
+
+class Span:
+    """The timing for one stage of an export.
+
+    Code inside a :py:func:`timed` block can add to *bytes_read* to
+    report how much data the stage pulled from the catalog.
+
+    """
+
+    def __init__(self, stage: str, fields: dict[str, Any]):
+        self.stage = stage
+        self.fields = fields
+        self.bytes_read = 0
+        self.duration = None
+
+    def __repr__(self):
+        return f"<Span {self.stage}: {self.duration} s, {self.bytes_read} bytes>"
+
+
+@contextmanager
+def timed(stage: str, **fields) -> Iterator[Span]:
+    """Time the code in this block as one stage of an export.
+
+    Extra keyword arguments (e.g. the run's uid or the stream name)
+    are included in the log record, but not in metrics labels.
+
+    """
+    span = Span(stage, fields)
+    t0 = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.duration = time.perf_counter() - t0
+        log.debug(
+            f"Export stage {stage} took {span.duration:.3f} s "
+            f"({span.bytes_read} bytes read): {fields}",
+            extra={
+                "stage": stage,
+                "duration": span.duration,
+                "bytes_read": span.bytes_read,
+                **fields,
+            },
+        )
+        if metrics_enabled():
+            STAGE_DURATION.labels(stage=stage).observe(span.duration)
+            if span.bytes_read > 0:
+                BYTES_READ.labels(stage=stage).inc(span.bytes_read)
+
+
+def record_output(media_type: str, num_bytes: int):
+    """Report the size of a finished export."""
+    log.debug(
+        f"Exported {num_bytes} bytes of {media_type}",
+        extra={"media_type": media_type, "bytes_produced": num_bytes},
+    )
+    if metrics_enabled():
+        BYTES_PRODUCED.labels(media_type=media_type).inc(num_bytes)
+
+
+async def count_output(
+    chunks: AsyncIterable[bytes], media_type: str
+) -> AsyncIterator[bytes]:
+    """Pass along the *chunks* of a streamed export, reporting their size."""
+    num_bytes = 0
+    async for chunk in chunks:
+        num_bytes += len(chunk)
+        yield chunk
+    record_output(media_type, num_bytes)
+
+
+def measure_output(result, media_type: str):
+    """Report the size of a serializer's *result*, and pass it along.
+
+    *result* can be a whole export (e.g. ``bytes``), or an async
+    iterator of chunks that gets counted as it is sent.
+
+    """
+    if isinstance(result, AsyncIterable):
+        return count_output(result, media_type)
+    record_output(media_type, len(result))
+    return result
+
+
+def nbytes(data) -> int:
+    """How much memory a block of data read from the catalog uses."""
+    if hasattr(data, "memory_usage"):
+        # Data frames
+        return int(data.memory_usage(index=False).sum())
+    return getattr(data, "nbytes", 0)
+
+
+def record_cache_lookup(hit: bool):
+    """Count one lookup in the export cache."""
+    if metrics_enabled():
+        (CACHE_HITS if hit else CACHE_MISSES).inc()
+
+
+def record_cache_size(num_bytes: int):
+    """Report the total size of the export cache's files."""
+    if metrics_enabled():
+        CACHE_SIZE.set(num_bytes)
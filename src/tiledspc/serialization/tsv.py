@@ -1,20 +1,36 @@
 import asyncio
 import datetime as dt
-import io
 import logging
-from collections.abc import Mapping
-from typing import IO, Any
+import zipfile
+from collections.abc import AsyncIterable, AsyncIterator, Iterator, Mapping, Sequence
+from typing import Any
 
+import numpy as np
 from pandas import DataFrame
 from tiled.catalog.adapter import CatalogNodeAdapter
 from tiled.utils import SerializationError
 
-__all__ = ["serialize_xdi"]
+from tiledspc.serialization import settings
+from tiledspc.serialization.cache import cache_chunks, default_cache
+from tiledspc.serialization.catalog import find_runs, iter_table, lookup, read_table
+from tiledspc.serialization.offload import run_encoder
+from tiledspc.serialization.streaming import file_view, iter_file, spooled_file
+from tiledspc.serialization.timing import measure_output, timed
+
+__all__ = ["serialize_xdi", "serialize_tsv", "serialize_xdi_zip"]
 
 
 log = logging.getLogger(__name__)
 
 
+TSV_MEDIA_TYPE = "text/tab-separated-values"
+XDI_MEDIA_TYPE = "text/x-xdi"
+ZIP_MEDIA_TYPE = "application/zip"
+
+# How many rows get formatted together when encoding the data section
+ROWS_PER_BLOCK = 10000
+
+
 def headers(
     metadata: Mapping[str, Mapping],
     data_keys: Mapping[str, Mapping],
@@ -96,6 +112,9 @@ async def load_datasets(
 ) -> tuple[CatalogNodeAdapter, CatalogNodeAdapter, CatalogNodeAdapter]:
     """Decide which datasets to plot.
 
+    Only these nodes are looked up, not the other children of the
+    run and stream.
+
     Returns
     =======
     stream_node
@@ -103,22 +122,160 @@ async def load_datasets(
     internal_node
       The node for the internal data frame.
     config_node
-      The node for the internal config data frame.
+      The node for the internal config data frame, or None if the
+      stream has no energy configuration.
+
+    """
+    with timed("load_datasets"):
+        stream_node = await lookup(node, "primary")
+
+        async def lookup_energy():
+            try:
+                return await lookup(stream_node, "config", "energy")
+            except KeyError:
+                return None
+
+        events_node, energy_node = await asyncio.gather(
+            lookup(stream_node, "internal", "events"), lookup_energy()
+        )
+    return stream_node, events_node, energy_node
+
+
+def encode_rows(
+    data: DataFrame | Mapping[str, np.ndarray],
+    columns: Sequence[str],
+    *,
+    precision: int | None = None,
+    block_size: int = ROWS_PER_BLOCK,
+) -> Iterator[bytes]:
+    """Encode the rows of a data frame as tab-separated text.
+
+    Rows are formatted a block at a time with a single ``%``
+    operation, so no intermediate per-row strings get built. Missing
+    values (NaN) are written as empty fields, same as
+    :py:meth:`pandas.DataFrame.to_csv`.
+
+    Parameters
+    ==========
+    data
+      The table to encode, either as a data frame or a mapping of
+      column names to arrays.
+    columns
+      Which columns of *data* to include, in order.
+    precision
+      Number of significant digits for floating-point columns. If
+      omitted, the shortest representation that round-trips is used.
+    block_size
+      Number of rows to format for each yielded chunk of bytes.
+
     """
-    items = {key: node for key, node in await node.items_range(0, None)}
-    stream_node = items["primary"]
-    stream_items = {key: node for key, node in await stream_node.items_range(0, None)}
-    internal_items = {
-        key: node for key, node in await stream_items["internal"].items_range(0, None)
-    }
-    config_items = {
-        key: node for key, node in await stream_items["config"].items_range(0, None)
-    }
+    columns = list(columns)
+    num_cols = len(columns)
+    if num_cols == 0:
+        return
+    values = [np.asarray(data[col]) for col in columns]
+    num_rows = len(values[0])
+    formats = [
+        (
+            f"%.{precision}g"
+            if (precision is not None and vals.dtype.kind == "f")
+            else "%s"
+        )
+        for vals in values
+    ]
+    for start in range(0, num_rows, block_size):
+        block = [vals[start : start + block_size] for vals in values]
+        num_rows = len(block[0])
+        row_formats = list(formats)
+        # Interleave the columns so they can be formatted in row order
+        flat = np.empty(num_rows * num_cols, dtype=object)
+        for idx, col_values in enumerate(block):
+            if col_values.dtype.kind == "f" and np.isnan(col_values).any():
+                fmt = row_formats[idx]
+                col_values = [
+                    "" if np.isnan(val) else fmt % val for val in col_values.tolist()
+                ]
+                row_formats[idx] = "%s"
+            flat[idx::num_cols] = col_values
+        row_format = "\t".join(row_formats) + "\n"
+        yield ((row_format * num_rows) % tuple(flat)).encode("utf-8")
+
+
+def xdi_header(
+    metadata: dict[str, Any],
+    data_keys_: Mapping[str, Mapping],
+    energy_config: DataFrame | None,
+    *,
+    strict: bool,
+) -> bytes:
+    """Encode the header lines of an XDI file, including column names."""
     try:
-        energy_frame = config_items["energy"]
-    except KeyError:
-        energy_frame = None
-    return stream_node, internal_items["events"], energy_frame
+        d_spacing = energy_config["energy-monochromator-d_spacing"].values[0]
+    except TypeError:
+        d_spacing = None
+    hdrs = list(
+        headers(metadata, data_keys=data_keys_, d_spacing=f"{d_spacing}", strict=strict)
+    )
+    cols = "\t".join(data_keys_.keys())
+    hdrs.append(f"# {cols}")
+    return ("\n".join(hdrs) + "\n").encode("utf-8")
+
+
+def encode_chunks(
+    data: DataFrame | Mapping[str, np.ndarray],
+    columns: Sequence[str],
+    *,
+    precision: int | None = None,
+) -> list[bytes]:
+    """Encode all the rows of *data*, as for :py:func:`encode_rows`."""
+    return list(encode_rows(data, columns=columns, precision=precision))
+
+
+def iter_xdi(
+    metadata: dict[str, Any],
+    stream_metadata: dict[str, Any],
+    data: DataFrame,
+    energy_config: DataFrame,
+    *,
+    strict: bool,
+    precision: int | None = None,
+) -> Iterator[bytes]:
+    """Generate the encoded chunks of an XDI file.
+
+    The first chunk holds the headers, followed by blocks of data
+    rows. See :py:func:`build_xdi` for a description of the
+    parameters.
+
+    """
+    data_keys_ = data_keys(stream_metadata)
+    yield xdi_header(metadata, data_keys_, energy_config, strict=strict)
+    yield from encode_rows(data, columns=data_keys_.keys(), precision=precision)
+
+
+async def stream_xdi(
+    header: bytes,
+    tables: AsyncIterable[DataFrame],
+    columns: Sequence[str],
+    *,
+    precision: int | None = None,
+) -> AsyncIterator[bytes]:
+    """Generate the encoded chunks of an XDI file from pieces of a table.
+
+    *header* is sent first, followed by the rows of each data frame
+    in *tables* as they arrive.
+
+    """
+    yield header
+    async for data in tables:
+        # Hand over plain arrays, which are cheaper to send to another
+        # process than a data frame
+        arrays = {col: data[col].to_numpy() for col in columns}
+        with timed("encode_rows", num_rows=len(data)):
+            chunks = await run_encoder(
+                encode_chunks, arrays, columns=columns, precision=precision
+            )
+        for chunk in chunks:
+            yield chunk
 
 
 def build_xdi(
@@ -128,81 +285,189 @@ def build_xdi(
     energy_config: DataFrame,
     *,
     strict: bool,
-) -> IO[bytes]:
-    """Build an XDI string based on data and metadata.
+    precision: int | None = None,
+) -> bytes:
+    """Build an encoded XDI file based on data and metadata.
 
     Parameters
     ==========
     strict
       If true, raise an exception if required metadata keys are not
       found. Otherwise, missing keys are omitted from the header.
+    precision
+      Number of significant digits for floating-point data.
 
     """
-    data_keys_ = data_keys(stream_metadata)
-    try:
-        d_spacing = energy_config["energy-monochromator-d_spacing"].values[0]
-    except TypeError:
-        d_spacing = None
-    # Write headers
-    xdi_text = ""
-    hdrs = headers(
-        metadata, data_keys=data_keys_, d_spacing=f"{d_spacing}", strict=strict
+    with timed("build_xdi", num_rows=len(data)):
+        chunks = iter_xdi(
+            metadata=metadata,
+            stream_metadata=stream_metadata,
+            data=data,
+            energy_config=energy_config,
+            strict=strict,
+            precision=precision,
+        )
+        return b"".join(chunks)
+
+
+async def export_text(
+    node,
+    metadata,
+    media_type: str,
+    *,
+    strict: bool,
+    stream: bool | None,
+    precision: int | None,
+):
+    """Export a bluesky run's primary stream as XDI-style text.
+
+    The events table is read one partition at a time and each piece
+    is encoded as soon as it arrives. If *stream* is true, the encoded
+    chunks are returned as an async iterator; otherwise they are
+    collected in a spooled file and returned as a buffer (see
+    :py:func:`~tiledspc.serialization.streaming.file_view`).
+
+    """
+    if stream is None:
+        stream = settings.STREAM_EXPORTS
+    if precision is None:
+        precision = settings.XDI_PRECISION
+    cache = default_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(metadata, media_type, {"precision": precision})
+        if (fd := cache.open(cache_key)) is not None:
+            if stream:
+                return iter_file(fd)
+            return file_view(fd)
+    stream_node, data_node, config_node = await load_datasets(node)
+    # Get extra data
+    if strict and config_node is None:
+        raise SerializationError(
+            "Could not read needed configuration data for XDI file."
+        )
+    energy_config = await read_table(config_node) if strict else None
+    # Build the header now so that any problems are reported before
+    # the response starts
+    data_keys_ = data_keys(stream_node.metadata())
+    header = xdi_header(metadata, data_keys_, energy_config, strict=strict)
+    # Only fetch the hinted columns that will end up in the file
+    columns = list(data_keys_.keys())
+    chunks = stream_xdi(
+        header,
+        tables=iter_table(data_node, columns=columns),
+        columns=columns,
+        precision=precision,
     )
-    xdi_text += "\n".join(hdrs) + "\n"
-    # Write data
-    cols = "\t".join(data_keys_.keys())
-    xdi_text += f"# {cols}\n"
-    buffer = io.StringIO()
-    data.to_csv(buffer, sep="\t", header=False, columns=data_keys_.keys(), index=False)
-    buffer.seek(0)
-    xdi_text += buffer.read()
-    return xdi_text
+    chunks = cache_chunks(chunks, cache, cache_key)
+    if stream:
+        return chunks
+    fd = spooled_file()
+    try:
+        async for chunk in chunks:
+            fd.write(chunk)
+    except BaseException:
+        fd.close()
+        raise
+    return file_view(fd)
 
 
-async def serialize_tsv(node, metadata, filter_for_access):
+async def serialize_tsv(
+    node, metadata, filter_for_access, *, stream=None, precision=None
+):
     """Write a bluesky run as tab-separated values.
 
     Assumes that *node* is a BlueskyRun.
 
     Includes some headers, though nothing is required."
 
+    If *stream* is true, the file is sent to the client piece by piece
+    as the events table is read. *precision* is the number of
+    significant digits for floating-point data. Both default to the
+    values in :py:mod:`tiledspc.serialization.settings`.
+
     """
-    stream_node, data_node, config_node = await load_datasets(node)
-    # Get extra data
-    data = await data_node.read()
-    xdi_text = build_xdi(
-        metadata=metadata,
-        stream_metadata=stream_node.metadata(),
-        data=data,
-        energy_config=None,
+    result = await export_text(
+        node,
+        metadata,
+        TSV_MEDIA_TYPE,
         strict=False,
+        stream=stream,
+        precision=precision,
     )
-    return xdi_text.encode("utf-8")
+    return measure_output(result, TSV_MEDIA_TYPE)
 
 
-async def serialize_xdi(node, metadata, filter_for_access):
+async def serialize_xdi(
+    node, metadata, filter_for_access, *, stream=None, precision=None
+):
     """Write a bluesky run in XDI format.
 
     Assumes that *node* is a BlueskyRun.
 
     Follows the XDI spectroscopy definition."
 
+    If *stream* is true, the file is sent to the client piece by piece
+    as the events table is read. *precision* is the number of
+    significant digits for floating-point data. Both default to the
+    values in :py:mod:`tiledspc.serialization.settings`.
+
     """
-    stream_node, data_node, config_node = await load_datasets(node)
-    # Get extra data
-    if config_node is None:
-        raise SerializationError(
-            "Could not read needed configuration data for XDI file."
-        )
-    data, energy_config = await asyncio.gather(
-        data_node.read(),
-        config_node.read(),
-    )
-    xdi_text = build_xdi(
-        metadata=metadata,
-        stream_metadata=stream_node.metadata(),
-        data=data,
-        energy_config=energy_config,
+    result = await export_text(
+        node,
+        metadata,
+        XDI_MEDIA_TYPE,
         strict=True,
+        stream=stream,
+        precision=precision,
+    )
+    return measure_output(result, XDI_MEDIA_TYPE)
+
+
+async def serialize_xdi_zip(
+    node, metadata, filter_for_access, *, stream=None, precision=None
+):
+    """Write a zip archive with one XDI file for each bluesky run.
+
+    *node* is usually a container of runs (e.g. search results), but
+    can also be a single BlueskyRun. Runs are read concurrently, up to
+    ``settings.MAX_CONCURRENT_RUNS`` at a time, and each file is named
+    after the run's uid.
+
+    *stream* and *precision* are the same as for
+    :py:func:`serialize_xdi`.
+
+    """
+    if stream is None:
+        stream = settings.STREAM_EXPORTS
+    runs = await find_runs(node, metadata)
+    limiter = asyncio.Semaphore(settings.MAX_CONCURRENT_RUNS)
+
+    async def export_run(uid, run_node, run_md):
+        async with limiter:
+            try:
+                return await export_text(
+                    run_node,
+                    run_md,
+                    XDI_MEDIA_TYPE,
+                    strict=True,
+                    stream=False,
+                    precision=precision,
+                )
+            except SerializationError as exc:
+                raise SerializationError(f"Could not export run {uid}: {exc}")
+
+    xdi_files = await asyncio.gather(
+        *(export_run(uid, run_node, run_md) for uid, (run_node, run_md) in runs.items())
     )
-    return xdi_text.encode("utf-8")
+    fd = spooled_file()
+    try:
+        with zipfile.ZipFile(fd, mode="w", compression=zipfile.ZIP_DEFLATED) as zfile:
+            for uid, xdi_bytes in zip(runs.keys(), xdi_files):
+                zfile.writestr(f"{uid}.xdi", xdi_bytes)
+    except BaseException:
+        fd.close()
+        raise
+    if stream:
+        return measure_output(iter_file(fd), ZIP_MEDIA_TYPE)
+    return measure_output(file_view(fd), ZIP_MEDIA_TYPE)
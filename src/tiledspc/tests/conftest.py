@@ -202,33 +202,62 @@ def tree(tmpdir):
     return in_memory(writable_storage=str(tmpdir))
 
 
+def write_xafs_run(client):
+    """Write the streams of a sample XAFS run into the *client* container."""
+    # Write sample data
+    primary = client.create_container(
+        "primary", metadata={"hints": hints, "data_keys": data_keys}
+    )
+    internal = primary.create_container("internal")
+    internal.write_dataframe(xafs_events, key="events")
+    baseline = client.create_container(
+        "baseline",
+        metadata={
+            "hints": {"aps_current": {"fields": ["aps_current"]}},
+            "data_keys": baseline_data_keys,
+        },
+    )
+    internal = baseline.create_container("internal")
+    internal.write_dataframe(xafs_baseline, key="events")
+    # Fluorescence detector data
+    external = primary.create_container("external")
+    external.write_array(np.zeros(shape=(100, 8, 4096)), key="ge_8element")
+    external.write_array(np.ones(shape=(100,)), key="ge_8element-element0-all_event")
+    config = primary.create_container("config")
+    for key, cfg in xafs_config.items():
+        config.write_dataframe(cfg, key=key)
+
+
 @pytest.fixture()
 def xafs_run(tree):
     with Context.from_app(build_app(tree)) as context:
         client = from_context(context)
-        # Write sample data
-        primary = client.create_container(
-            "primary", metadata={"hints": hints, "data_keys": data_keys}
-        )
-        internal = primary.create_container("internal")
-        internal.write_dataframe(xafs_events, key="events")
-        baseline = client.create_container(
-            "baseline",
-            metadata={
-                "hints": {"aps_current": {"fields": ["aps_current"]}},
-                "data_keys": baseline_data_keys,
-            },
-        )
-        internal = baseline.create_container("internal")
-        internal.write_dataframe(xafs_baseline, key="events")
-        # Fluorescence detector data
-        external = primary.create_container("external")
-        external.write_array(np.zeros(shape=(100, 8, 4096)), key="ge_8element")
-        external.write_array(
-            np.ones(shape=(100,)), key="ge_8element-element0-all_event"
-        )
-        config = primary.create_container("config")
-        for key, cfg in xafs_config.items():
-            config.write_dataframe(cfg, key=key)
-        # Write a baseline stream
+        write_xafs_run(client)
+        yield tree
+
+
+xafs_uids = [
+    "e1b7b3a4-0d0c-4c4b-9b3c-6a4a1f0c0a01",
+    "e1b7b3a4-0d0c-4c4b-9b3c-6a4a1f0c0a02",
+]
+
+
+@pytest.fixture()
+def xafs_catalog(tree):
+    """A catalog holding several XAFS runs, as if from a search."""
+    with Context.from_app(build_app(tree)) as context:
+        client = from_context(context)
+        for idx, uid in enumerate(xafs_uids):
+            start_doc = {
+                "uid": uid,
+                "scan_id": idx + 1,
+                "edge": "Ni_K",
+                "time": 1665065697.3635247 + idx,
+                "versions": {"bluesky": "1.9.0"},
+            }
+            run = client.create_container(
+                uid,
+                metadata={"start": start_doc, "stop": {"exit_status": "success"}},
+            )
+            write_xafs_run(run)
         yield tree
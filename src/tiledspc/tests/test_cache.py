@@ -0,0 +1,149 @@
+import asyncio
+import io
+import os
+import tracemalloc
+from unittest import mock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.cache import ExportCache, cache_chunks
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.tsv import serialize_xdi
+from tiledspc.tests.test_catalog_tsv import metadata
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    return ExportCache(tmp_path, max_size=1000)
+
+
+def test_cache_key(cache):
+    key = cache.key(metadata, "text/x-xdi")
+    assert key == cache.key(metadata, "text/x-xdi")
+    assert key != cache.key(metadata, "application/x-nexus")
+    assert key != cache.key(metadata, "text/x-xdi", options={"strict": False})
+
+
+def test_in_progress_runs(cache):
+    """Runs without a stop document should never be cached."""
+    key = cache.key({"start": metadata["start"]}, "text/x-xdi")
+    assert key is None
+    cache.store(key, io.BytesIO(b"Hello"))
+    assert cache.read(key) is None
+    assert list(cache.directory.iterdir()) == []
+
+
+def test_hits_and_misses(cache):
+    key = cache.key(metadata, "text/x-xdi")
+    assert cache.read(key) is None
+    cache.store(key, io.BytesIO(b"Hello"))
+    assert cache.read(key) == b"Hello"
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_cache_metrics(cache, monkeypatch):
+    """Hits, misses and size should be exported for Prometheus."""
+    monkeypatch.setattr(settings, "EXPORT_METRICS", True)
+    hits = REGISTRY.get_sample_value("tiledspc_export_cache_hits_total")
+    misses = REGISTRY.get_sample_value("tiledspc_export_cache_misses_total")
+    key = cache.key(metadata, "text/x-xdi")
+    assert cache.read(key) is None
+    cache.store(key, io.BytesIO(b"Hello"))
+    assert cache.read(key) == b"Hello"
+    assert REGISTRY.get_sample_value("tiledspc_export_cache_hits_total") == hits + 1
+    assert REGISTRY.get_sample_value("tiledspc_export_cache_misses_total") == misses + 1
+    assert REGISTRY.get_sample_value("tiledspc_export_cache_size_bytes") == 5
+
+
+def test_lru_eviction(cache):
+    cache.max_size = 1200
+    keys = [cache.key(metadata, f"text/x-{idx}") for idx in range(3)]
+    for idx, key in enumerate(keys):
+        cache.store(key, io.BytesIO(b"0" * 400))
+        # Make the access order unambiguous
+        os.utime(cache.path(key), (idx, idx))
+    # Reading the oldest makes it the most recently used
+    assert cache.read(keys[0]) is not None
+    cache.store(cache.key(metadata, "text/x-new"), io.BytesIO(b"0" * 400))
+    assert cache.path(keys[0]).exists()
+    assert not cache.path(keys[1]).exists()
+    assert cache.path(keys[2]).exists()
+
+
+@pytest.mark.asyncio
+async def test_cached_xdi(xafs_run, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_CACHE_DIR", str(tmp_path / "cache"))
+    first = await serialize_xdi(xafs_run, metadata=metadata, filter_for_access=None)
+    # Second time should not need to touch the catalog
+    second = await serialize_xdi(None, metadata=metadata, filter_for_access=None)
+    assert first == second
+
+
+@pytest.mark.asyncio
+async def test_cached_nexus_no_copy(xafs_run, tmp_path, monkeypatch):
+    """Cached exports should be mapped into the response, not read."""
+    monkeypatch.setattr(settings, "EXPORT_CACHE_DIR", str(tmp_path / "cache"))
+    first = await serialize_nexus(xafs_run, metadata=metadata, filter_for_access=None)
+    assert isinstance(first, memoryview)
+    tracemalloc.start()
+    try:
+        second = await serialize_nexus(None, metadata=metadata, filter_for_access=None)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert second == first
+    assert peak < len(second) / 2
+
+
+def test_evicted_while_opening(cache, monkeypatch):
+    """A file evicted by another worker after opening can still be read."""
+    key = cache.key(metadata, "text/x-xdi")
+    cache.store(key, io.BytesIO(b"Hello"))
+
+    def utime(path, *args, **kwargs):
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", utime)
+    assert cache.read(key) == b"Hello"
+    assert cache.stats() == {"hits": 1, "misses": 0}
+
+
+@pytest.mark.asyncio
+async def test_nexus_rendered_into_cache(xafs_run, tmp_path, monkeypatch):
+    """Exports should be renamed into the cache off the event loop, not copied."""
+    monkeypatch.setattr(settings, "EXPORT_CACHE_DIR", str(tmp_path / "cache"))
+    threads = []
+    to_thread = asyncio.to_thread
+
+    async def spy(func, *args, **kwargs):
+        threads.append(func.__name__)
+        return await to_thread(func, *args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "to_thread", spy)
+    store = mock.patch.object(ExportCache, "store", side_effect=AssertionError)
+    with store:
+        data = await serialize_nexus(
+            xafs_run, metadata=metadata, filter_for_access=None
+        )
+    assert threads[-1] == "commit"
+    cached = list((tmp_path / "cache").iterdir())
+    assert [path.suffix for path in cached] == [ExportCache.suffix]
+    assert cached[0].read_bytes() == data
+
+
+@pytest.mark.asyncio
+async def test_interrupted_chunks(cache):
+    """Exports cut short should leave nothing in the cache directory."""
+
+    async def chunks():
+        yield b"Hello"
+        raise RuntimeError("Client went away")
+
+    key = cache.key(metadata, "text/x-xdi")
+    with pytest.raises(RuntimeError):
+        async for chunk in cache_chunks(chunks(), cache, key):
+            pass
+    assert list(cache.directory.iterdir()) == []
@@ -1,11 +1,35 @@
+import asyncio
 import datetime
 import io
 from unittest import mock
 
+import h5py
+import numpy as np
+import pandas as pd
 import pytest
 import pytest_asyncio
+from nexusformat.nexus.tree import NXentry
+from tiled.adapters.array import ArrayAdapter
+from tiled.catalog.adapter import CatalogContainerAdapter
+from tiled.utils import SerializationError
 
-from tiledspc.serialization.nexus import NexusIO, serialize_nexus, write_stream
+from tiledspc.serialization import settings
+from tiledspc.serialization.nexus import (
+    NEXUS_BACKENDS,
+    NexusIO,
+    SharedArrays,
+    chunk_shape,
+    compression_filters,
+    copy_arrays,
+    empty_field,
+    flatten_metadata,
+    select_fields,
+    serialize_nexus,
+    to_hdf_type,
+    write_blocks,
+    write_stream,
+)
+from tiledspc.tests.conftest import xafs_uids
 
 specification = """
 root:NXroot
@@ -63,39 +87,37 @@ root:NXroot
               @axes = 'time'
               @signal = 'value'
               EPOCH = [10 25]
+                @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
               time = [ 0 15]
+                @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
                 @units = 's'
               value = [130.  204.1]
                 @units = 'mA'
             aps_fill_number:NXdata
               @axes = 'time'
               @signal = 'value'
-              EPOCH = [10 25]
-              time = [ 0 15]
-                @units = 's'
+              EPOCH -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/baseline/aps_current/EPOCH
+              time -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/baseline/aps_current/time
               value = [1 2]
             aps_global_feedback:NXdata
               @axes = 'time'
               @signal = 'value'
-              EPOCH = [10 25]
-              time = [ 0 15]
-                @units = 's'
+              EPOCH -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/baseline/aps_current/EPOCH
+              time -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/baseline/aps_current/time
               value = [ True False]
           primary:NXnote
             I0-net_current:NXdata
               @axes = 'time'
               @signal = 'value'
-              EPOCH = float64(100)
-              time = float64(100)
-                @units = 's'
+              EPOCH -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/EPOCH
+              time -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/time
               value = float64(100)
                 @units = 'A'
             It-net_current:NXdata
               @axes = 'time'
               @signal = 'value'
-              EPOCH = float64(100)
-              time = float64(100)
-                @units = 's'
+              EPOCH -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/EPOCH
+              time -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/time
               value = float64(100)
                 @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
                 @units = 'A'
@@ -103,7 +125,9 @@ root:NXroot
               @axes = 'time'
               @signal = 'value'
               EPOCH = float64(100)
+                @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
               time = float64(100)
+                @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
                 @units = 's'
               value = float64(100)
                 @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
@@ -111,9 +135,8 @@ root:NXroot
             energy-id-energy-readback:NXdata
               @axes = 'time'
               @signal = 'value'
-              EPOCH = float64(100)
-              time = float64(100)
-                @units = 's'
+              EPOCH -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/EPOCH
+              time -> /7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrument/bluesky/streams/primary/energy/time
               value = float64(100)
                 @target = '/7d1daf1d-60c7-4aa7-a668-d1cd97e5335f/instrume...'
                 @units = 'keV'
@@ -206,11 +229,13 @@ metadata = {
 }
 
 
-@pytest_asyncio.fixture()
-async def nxfile(xafs_run):
+@pytest_asyncio.fixture(params=["nexusformat", "h5py"])
+async def nxfile(xafs_run, request):
     # Generate the headers
     buff = bytes(
-        await serialize_nexus(xafs_run, metadata=metadata, filter_for_access=None)
+        await serialize_nexus(
+            xafs_run, metadata=metadata, filter_for_access=None, backend=request.param
+        )
     )
     buff = io.BytesIO(buff)
     with NexusIO(buff, mode="r") as fd:
@@ -249,3 +274,356 @@ async def test_missing_hints(xafs_run):
             "hints": {"I0": {}},
         },
     )
+
+
+@pytest.mark.asyncio
+async def test_streaming_export(xafs_run):
+    """Can the file be sent in chunks instead of one big buffer."""
+    chunk_size = 64 * 1024
+    chunks = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        stream=True,
+        chunk_size=chunk_size,
+    )
+    chunks = [chunk async for chunk in chunks]
+    assert len(chunks) > 1
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    # Make sure the pieces go back together into a valid file
+    buff = io.BytesIO(b"".join(chunks))
+    with NexusIO(buff, mode="r") as fd:
+        tree = "\n" + fd.readfile().tree + "\n"
+    assert tree == specification
+
+
+@pytest.mark.asyncio
+async def test_write_blocks():
+    """Are external arrays copied one block at a time."""
+    array = np.arange(20 * 4 * 16, dtype="u4").reshape(20, 4, 16)
+    node = ArrayAdapter.from_array(array, chunks=((5, 5, 5, 5), (2, 2), (16,)))
+    node.read = mock.MagicMock(side_effect=AssertionError("read whole array"))
+    buff = io.BytesIO()
+    with NexusIO(buff, mode="w") as nxfile:
+        root = nxfile.readfile()
+        root["entry"] = NXentry()
+        field = empty_field(root["entry"], "value", node)
+        await write_blocks(node, field)
+        dataset = nxfile._file["entry/value"]
+        assert dataset.chunks == (5, 2, 16)
+        assert dataset.dtype == np.dtype("u4")
+        np.testing.assert_array_equal(dataset[()], array)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_array_copies(monkeypatch):
+    """Are external arrays read concurrently, but only up to the limit."""
+    monkeypatch.setattr(settings, "MAX_CONCURRENT_READS", 2)
+    in_flight = 0
+    max_in_flight = 0
+
+    def slow_array(array):
+        node = ArrayAdapter.from_array(array, chunks=((2, 2), (4,)))
+        read_block = node.read_block
+
+        async def slow_read_block(block):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return read_block(block)
+
+        node.read_block = slow_read_block
+        return node
+
+    arrays = [np.full((4, 4), idx) for idx in range(4)]
+    buff = io.BytesIO()
+    with NexusIO(buff, mode="w") as nxfile:
+        root = nxfile.readfile()
+        root["entry"] = NXentry()
+        copies = []
+        for idx, array in enumerate(arrays):
+            node = slow_array(array)
+            copies.append((node, empty_field(root["entry"], f"array{idx}", node)))
+        await copy_arrays(copies)
+        for idx, array in enumerate(arrays):
+            np.testing.assert_array_equal(nxfile._file[f"entry/array{idx}"][()], array)
+    assert max_in_flight == 2
+
+
+def test_chunk_shape():
+    # Several frames fit in one chunk
+    assert chunk_shape((100, 8, 4096), itemsize=8, frame_ndim=2) == (4, 8, 4096)
+    # Frames are too big for one chunk
+    assert chunk_shape((10, 2048, 2048), itemsize=2, frame_ndim=2) == (1, 256, 2048)
+    # Scalar columns
+    assert chunk_shape((10**6,), itemsize=8) == (131072,)
+    assert chunk_shape((100,), itemsize=8) == (100,)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["nexusformat", "h5py"])
+@pytest.mark.parametrize(
+    "compression,filter_id", [("lzf", "lzf"), ("blosc", "32001"), ("none", None)]
+)
+async def test_compression(xafs_run, backend, compression, filter_id):
+    buff = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        backend=backend,
+        compression=compression,
+    )
+    uid = metadata["start"]["uid"]
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        stream = h5file[f"{uid}/instrument/bluesky/streams/primary"]
+        dataset = stream["ge_8element/value"]
+        assert dataset.chunks == (4, 8, 4096)
+        filters = list(dataset._filters.keys())
+        if filter_id is None:
+            assert filters == []
+        else:
+            assert filter_id in filters
+        assert np.all(dataset[()] == 0)
+        # Small datasets are left alone
+        assert stream["energy/value"].compression is None
+
+
+def test_compression_level():
+    assert compression_filters("gzip", 9)["compression_opts"] == 9
+    assert compression_filters("lzf") == {"compression": "lzf", "shuffle": True}
+    # Filters without a level should not silently ignore one
+    for compression in ["lzf", "bitshuffle", "lz4", "none"]:
+        with pytest.raises(SerializationError):
+            compression_filters(compression, 9)
+
+
+@pytest.mark.asyncio
+async def test_default_compression_level(xafs_run, monkeypatch):
+    """The default level should not stop filters without levels."""
+    monkeypatch.setattr(settings, "NEXUS_COMPRESSION_LEVEL", 6)
+    await serialize_nexus(
+        xafs_run, metadata=metadata, filter_for_access=None, compression="lzf"
+    )
+    with pytest.raises(SerializationError):
+        await serialize_nexus(
+            xafs_run,
+            metadata=metadata,
+            filter_for_access=None,
+            compression="bitshuffle",
+            compression_level=9,
+        )
+
+
+def test_select_fields():
+    md = {
+        "data_keys": {
+            "energy": {"shape": []},
+            "I0": {"shape": []},
+            "ge_8element": {"shape": [8, 4096], "external": "STREAM:"},
+        },
+        "hints": {"energy": {"fields": ["energy"]}, "I0": {"fields": ["I0"]}},
+    }
+    selected = select_fields(
+        md, fields=["energy", "ge_8element"], exclude_external=True
+    )
+    assert list(selected["data_keys"].keys()) == ["energy"]
+    assert selected["hints"] == {"energy": {"fields": ["energy"]}, "I0": {"fields": []}}
+    # The original metadata should be unchanged
+    assert len(md["data_keys"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_field_selection(xafs_run):
+    buff = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        streams="primary,baseline",
+        fields="energy,It-net_current,ge_8element",
+        exclude_external=True,
+    )
+    uid = metadata["start"]["uid"]
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        streams = h5file[f"{uid}/instrument/bluesky/streams"]
+        # Baseline has none of the requested fields
+        assert list(streams.keys()) == ["primary"]
+        assert sorted(streams["primary"].keys()) == ["It-net_current", "energy"]
+        assert sorted(h5file[f"{uid}/data"].keys()) == ["It-net_current", "energy"]
+
+
+@pytest.mark.asyncio
+async def test_lookup_requested_streams(xafs_run, monkeypatch):
+    """Only the requested streams and their datasets should be fetched."""
+    items_range = mock.AsyncMock()
+    monkeypatch.setattr(CatalogContainerAdapter, "items_range", items_range)
+    buff = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        streams="primary",
+        fields="energy,ge_8element",
+    )
+    items_range.assert_not_called()
+    uid = metadata["start"]["uid"]
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        streams = h5file[f"{uid}/instrument/bluesky/streams"]
+        assert sorted(streams["primary"].keys()) == ["energy", "ge_8element"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", NEXUS_BACKENDS)
+async def test_batch_export(xafs_catalog, backend):
+    """Can a container of runs be exported as one file."""
+    buff = await serialize_nexus(
+        xafs_catalog,
+        metadata={},
+        filter_for_access=None,
+        backend=backend,
+        exclude_external=True,
+    )
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        assert sorted(h5file.keys()) == xafs_uids
+        assert h5file.attrs["default"] == xafs_uids[0]
+        for uid in xafs_uids:
+            entry = h5file[uid]
+            assert entry.attrs["NX_class"] == "NXentry"
+            assert entry["entry_identifier"][()] == uid.encode()
+            assert entry["data/energy"].shape == (100,)
+
+
+@pytest.mark.asyncio
+async def test_batch_export_no_runs(xafs_run):
+    """Containers without runs (e.g. a stream) should not give an empty file."""
+    stream = await xafs_run.lookup_adapter(["primary"])
+    with pytest.raises(SerializationError, match="No runs"):
+        await serialize_nexus(
+            stream, metadata=stream.metadata(), filter_for_access=None
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", NEXUS_BACKENDS)
+async def test_incremental_export(xafs_run, backend):
+    """Can we export only the rows added since the last poll."""
+    buff = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        backend=backend,
+        streams="primary",
+        since=90,
+    )
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        entry = h5file[metadata["start"]["uid"]]
+        stream = entry["instrument/bluesky/streams/primary"]
+        assert stream.attrs["next_row"] == 100
+        assert stream.attrs["last_time"] == 15
+        np.testing.assert_equal(
+            stream["energy/value"][()], np.linspace(8300, 8400, num=100)[90:]
+        )
+        # Relative times still start from the beginning of the run
+        assert stream["energy/time"][0] == pytest.approx(90 * 15 / 99)
+        assert entry["data/ge_8element"].shape == (10, 8, 4096)
+
+
+@pytest.mark.asyncio
+async def test_incremental_export_streams(xafs_run):
+    """Each stream's cursor should pick up where that stream left off."""
+
+    async def export(since):
+        buff = await serialize_nexus(
+            xafs_run, metadata=metadata, filter_for_access=None, since=since
+        )
+        with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+            streams = h5file[metadata["start"]["uid"]]["instrument/bluesky/streams"]
+            cursors = {name: int(streams[name].attrs["next_row"]) for name in streams}
+            sizes = {
+                "primary": streams["primary/energy/value"].shape[0],
+                "baseline": streams["baseline/aps_current/value"].shape[0],
+            }
+        return cursors, sizes
+
+    cursors, sizes = await export("primary:90,baseline:1")
+    assert cursors == {"primary": 100, "baseline": 2}
+    assert sizes == {"primary": 10, "baseline": 1}
+    # Sending the cursors back gives only rows added since then
+    cursors, sizes = await export(cursors)
+    assert cursors == {"primary": 100, "baseline": 2}
+    assert sizes == {"primary": 0, "baseline": 0}
+    # Streams without a cursor are exported from the start
+    cursors, sizes = await export({"primary": 100})
+    assert sizes == {"primary": 0, "baseline": 2}
+
+
+@pytest.mark.asyncio
+async def test_incremental_export_ambiguous(xafs_run):
+    """One row number cannot be the cursor for several streams."""
+    with pytest.raises(SerializationError):
+        await serialize_nexus(
+            xafs_run, metadata=metadata, filter_for_access=None, since=90
+        )
+
+
+@pytest.mark.asyncio
+async def test_incremental_export_by_time(xafs_run):
+    buff = await serialize_nexus(
+        xafs_run,
+        metadata=metadata,
+        filter_for_access=None,
+        since_time=14.0,
+    )
+    with h5py.File(io.BytesIO(buff), mode="r") as h5file:
+        streams = h5file[metadata["start"]["uid"]]["instrument/bluesky/streams"]
+        # Timestamps are 15/99 s apart, so 7 rows are newer than 14 s
+        assert streams["primary/energy/value"].shape == (7,)
+        assert streams["primary/ge_8element/value"].shape == (7, 8, 4096)
+        assert streams["baseline/aps_current/value"].shape == (1,)
+        assert streams["primary"].attrs["next_row"] == 100
+
+
+@pytest.mark.asyncio
+async def test_write_trailing_blocks(tmp_path):
+    """Only blocks holding new rows should be read."""
+    arr = np.arange(100 * 3).reshape(100, 3)
+    node = ArrayAdapter.from_array(arr, chunks=((25, 25, 25, 25), (3,)))
+    with mock.patch.object(node, "read_block", wraps=node.read_block) as read_block:
+        with NexusIO(tmp_path / "test.nxs", mode="w") as nxfile:
+            root = nxfile.readfile()
+            root["entry"] = NXentry()
+            field = empty_field(root["entry"], "value", node, start=60)
+            await write_blocks(node, field)
+            np.testing.assert_equal(field.nxdata, arr[60:])
+    assert read_block.call_count == 2
+
+
+def test_to_hdf_type():
+    assert to_hdf_type({"a": [1, 2]}) == '{"a": [1, 2]}'
+    assert to_hdf_type([1, 2]) == "[1, 2]"
+    assert to_hdf_type(datetime.datetime(2022, 10, 6, 9, 14)) == "2022-10-06 09:14:00"
+    # Subclasses (e.g. pandas timestamps) get converted too
+    assert isinstance(to_hdf_type(pd.Timestamp("2022-10-06")), str)
+    assert to_hdf_type(3.5) == 3.5
+    assert to_hdf_type("hello") == "hello"
+
+
+def test_flatten_metadata():
+    flattened = flatten_metadata(
+        {"start": {"uid": "abc", "hints": {"dimensions": []}}, "stop": {"time": 1.0}}
+    )
+    assert flattened == {
+        "start.uid": "abc",
+        "start.hints": '{"dimensions": []}',
+        "stop.time": 1.0,
+    }
+
+
+def test_shared_arrays():
+    shared = SharedArrays()
+    times = np.linspace(0, 15, num=100)
+    assert shared.find(times) is None
+    shared.add(times, "energy/time")
+    assert shared.find(times.copy()) == "energy/time"
+    assert shared.find(times + 1) is None
+    assert shared.find(times.astype("float32")) is None
@@ -1,10 +1,26 @@
 import datetime
 import io
+import zipfile
+from unittest import mock
 
+import numpy as np
 import pandas as pd
+import pytest
 import pytest_asyncio
+from tiled.adapters.table import TableAdapter
+from tiled.catalog.adapter import CatalogContainerAdapter
+from tiled.utils import SerializationError
 
-from tiledspc.serialization.tsv import headers, serialize_tsv, serialize_xdi
+from tiledspc.serialization import settings, tsv
+from tiledspc.serialization.catalog import iter_children, iter_table
+from tiledspc.serialization.tsv import (
+    encode_rows,
+    headers,
+    serialize_tsv,
+    serialize_xdi,
+    serialize_xdi_zip,
+)
+from tiledspc.tests.conftest import xafs_uids
 
 # <BlueskyRun({'primary'})>
 metadata = {
@@ -90,7 +106,7 @@ async def xdi_text(xafs_run):
         metadata=metadata,
         filter_for_access=None,
     )
-    return xdi_text.decode("utf-8")
+    return bytes(xdi_text).decode("utf-8")
 
 
 @pytest_asyncio.fixture()
@@ -101,7 +117,7 @@ async def tsv_text(xafs_run):
         metadata=metadata,
         filter_for_access=None,
     )
-    return tsv_text.decode("utf-8")
+    return bytes(tsv_text).decode("utf-8")
 
 
 def test_required_headers(xdi_text):
@@ -161,3 +177,130 @@ def test_data(xdi_text):
     # Check the data
     df = pd.read_csv(buff, comment="#", sep="\t")
     assert len(df.columns) == 3
+
+
+def test_encode_rows():
+    """Check that encoded rows match what pandas would write."""
+    df = pd.DataFrame(
+        {
+            "energy": np.linspace(8300, 8400, num=25),
+            "I0": np.arange(25),
+            "It": np.random.default_rng().random(25),
+        }
+    )
+    df.loc[3, "It"] = np.nan
+    expected = df.to_csv(sep="\t", header=False, columns=["It", "energy"], index=False)
+    encoded = b"".join(encode_rows(df, columns=["It", "energy"], block_size=10))
+    assert encoded.decode("utf-8") == expected
+
+
+def test_encode_rows_precision():
+    df = pd.DataFrame({"energy": [8333.123456789, 8334.0], "I0": [10, 11]})
+    encoded = b"".join(encode_rows(df, columns=["energy", "I0"], precision=6))
+    assert encoded == b"8333.12\t10\n8334\t11\n"
+
+
+@pytest.mark.asyncio
+async def test_xdi_precision(xafs_run):
+    xdi_bytes = await serialize_xdi(
+        node=xafs_run, metadata=metadata, filter_for_access=None, precision=3
+    )
+    df = pd.read_csv(io.BytesIO(xdi_bytes), comment="#", sep="\t", header=None)
+    assert len(df) == 100
+    # Every value should have been rounded to 3 significant digits
+    for val in df[0]:
+        assert float(f"{val:.3g}") == val
+
+
+@pytest.mark.asyncio
+async def test_streaming_xdi(xafs_run, xdi_text):
+    """Can the file be sent in chunks as the table gets read."""
+    chunks = await serialize_xdi(
+        node=xafs_run, metadata=metadata, filter_for_access=None, stream=True
+    )
+    chunks = [chunk async for chunk in chunks]
+    assert len(chunks) > 1
+    assert b"".join(chunks).decode("utf-8") == xdi_text
+
+
+@pytest.mark.asyncio
+async def test_iter_table():
+    df = pd.DataFrame({"energy": np.linspace(8300, 8400, num=30), "I0": np.ones(30)})
+    node = TableAdapter.from_pandas(df, npartitions=3)
+    tables = [table async for table in iter_table(node, columns=["energy", "It"])]
+    assert len(tables) == 3
+    assert list(tables[0].columns) == ["energy"]
+    assert pd.concat(tables)["energy"].tolist() == df["energy"].tolist()
+
+
+@pytest.mark.asyncio
+async def test_iter_children(xafs_catalog, monkeypatch):
+    """Children of large containers should be fetched a page at a time."""
+    offsets = []
+    items_range = xafs_catalog.items_range
+
+    async def spy_items_range(offset, limit):
+        offsets.append((offset, limit))
+        return await items_range(offset, limit)
+
+    monkeypatch.setattr(xafs_catalog, "items_range", spy_items_range)
+    keys = [key async for key, child in iter_children(xafs_catalog, page_size=1)]
+    assert len(keys) == len(xafs_uids)
+    assert offsets == [(0, 1), (1, 1), (2, 1)]
+
+
+@pytest.mark.asyncio
+async def test_lookup_datasets(xafs_run, monkeypatch):
+    """Only the datasets that go in the file should be looked up."""
+    items_range = mock.AsyncMock()
+    monkeypatch.setattr(CatalogContainerAdapter, "items_range", items_range)
+    await serialize_xdi(node=xafs_run, metadata=metadata, filter_for_access=None)
+    items_range.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_reads_hinted_columns(xafs_run, monkeypatch):
+    """Only the columns that go in the file should be read."""
+    requested = []
+
+    def spy_iter_table(node, columns=None):
+        requested.append(columns)
+        return iter_table(node, columns=columns)
+
+    monkeypatch.setattr(tsv, "iter_table", spy_iter_table)
+    await serialize_tsv(node=xafs_run, metadata=metadata, filter_for_access=None)
+    assert requested == [["energy", "energy-id-energy-readback", "It-net_current"]]
+
+
+@pytest.mark.asyncio
+async def test_xdi_zip(xafs_catalog):
+    """Can a container of runs be exported as an archive of XDI files."""
+    zip_bytes = await serialize_xdi_zip(
+        node=xafs_catalog, metadata={}, filter_for_access=None
+    )
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zfile:
+        assert zfile.namelist() == [f"{uid}.xdi" for uid in xafs_uids]
+        for uid in xafs_uids:
+            xdi_text = zfile.read(f"{uid}.xdi").decode("utf-8")
+            assert "# XDI/1.0 bluesky/1.9.0" in xdi_text
+            assert f"# uid: {uid}" in xdi_text
+
+
+@pytest.mark.asyncio
+async def test_xdi_zip_too_many_runs(xafs_catalog, monkeypatch):
+    """Batch exports should refuse searches with too many runs."""
+    monkeypatch.setattr(settings, "MAX_BATCH_RUNS", len(xafs_uids) - 1)
+    with pytest.raises(SerializationError, match="more than 1 runs"):
+        await serialize_xdi_zip(node=xafs_catalog, metadata={}, filter_for_access=None)
+    monkeypatch.setattr(settings, "MAX_BATCH_RUNS", len(xafs_uids))
+    await serialize_xdi_zip(node=xafs_catalog, metadata={}, filter_for_access=None)
+
+
+@pytest.mark.asyncio
+async def test_xdi_zip_no_runs(xafs_run):
+    """Containers without runs (e.g. a stream) should not give an empty archive."""
+    stream = await xafs_run.lookup_adapter(["primary"])
+    with pytest.raises(SerializationError, match="No runs"):
+        await serialize_xdi_zip(
+            node=stream, metadata=stream.metadata(), filter_for_access=None
+        )
@@ -0,0 +1,442 @@
+import os
+import pathlib
+import shutil
+import sys
+from unittest import mock
+
+import numpy as np
+import pytest
+import tifffile
+from PIL import Image
+from tifffile.zarr import ZarrTiffStore
+from tiled.ndslice import NDSlice
+
+# image_data lives at the top of the repository, outside the package
+sys.path.insert(0, str(pathlib.Path(__file__).parents[3]))
+import image_data  # noqa: E402
+from image_data import LazyImage, lazy_image_array  # noqa: E402
+
+rng = np.random.default_rng(seed=0)
+gray16 = rng.integers(0, 2**16, (64, 48), dtype="u2")
+rgb = rng.integers(0, 255, (64, 48, 3), dtype="u1")
+stack = rng.integers(0, 2**16, (5, 32, 24), dtype="u2")
+
+
+def write_pil(path, pixels, **kwargs):
+    Image.fromarray(pixels).save(path, **kwargs)
+
+
+def write_gif(path):
+    frames = [Image.fromarray(frame) for frame in rgb.reshape(4, 16, 48, 3)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+
+
+def read_reference(path):
+    """Every frame of an image decoded by PIL, colors first."""
+    frames = []
+    with Image.open(path) as image:
+        mode = image_data.frames_mode(image)
+        for frame in range(getattr(image, "n_frames", 1)):
+            image.seek(frame)
+            pixels = np.asarray(image.convert(mode))
+            if pixels.ndim > 2:
+                pixels = np.moveaxis(pixels, -1, 0)
+            frames.append(pixels)
+    return frames[0] if len(frames) == 1 else np.stack(frames)
+
+
+IMAGES = {
+    "rgb.bmp": lambda path: write_pil(path, rgb),
+    "gray16.png": lambda path: write_pil(path, gray16),
+    "plain.tif": lambda path: tifffile.imwrite(path, gray16),
+    "zlib.tif": lambda path: tifffile.imwrite(
+        path, gray16, compression="zlib", rowsperstrip=8
+    ),
+    "contig_rgb.tif": lambda path: tifffile.imwrite(path, rgb, photometric="rgb"),
+    "planar_rgb.tif": lambda path: tifffile.imwrite(
+        path, np.moveaxis(rgb, -1, 0), photometric="rgb", planarconfig="separate"
+    ),
+    "stack.tif": lambda path: tifffile.imwrite(path, stack, compression="zlib"),
+    "animated.gif": write_gif,
+}
+
+
+@pytest.fixture(params=IMAGES.keys())
+def image_file(request, tmp_path):
+    path = tmp_path / request.param
+    IMAGES[request.param](path)
+    return path
+
+
+def lazy_array(path):
+    with Image.open(path) as image:
+        return lazy_image_array(path, image)
+
+
+def decoded_strips(calls):
+    """The TIFF strips (zarr chunks) that were read from the file."""
+    return [key for key in calls if not key.endswith(("json", ".zarray", ".zattrs"))]
+
+
+@pytest.fixture()
+def strip_reads():
+    """Record which TIFF strips get decoded through zarr."""
+    calls = []
+    get = ZarrTiffStore.get
+
+    async def spy(self, key, *args, **kwargs):
+        calls.append(key)
+        return await get(self, key, *args, **kwargs)
+
+    with mock.patch.object(ZarrTiffStore, "get", spy):
+        yield calls
+
+
+def test_lazy_image(image_file):
+    """Pixels should match PIL's, with the colors and frames first."""
+    expected = read_reference(image_file)
+    pixels = lazy_array(image_file)
+    assert pixels.shape == expected.shape
+    assert pixels.dtype == expected.dtype
+    np.testing.assert_array_equal(pixels.compute(), expected)
+    # Slices line up with the file's pixels too
+    np.testing.assert_array_equal(
+        pixels[..., 3:9, 5:7].compute(), expected[..., 3:9, 5:7]
+    )
+
+
+def test_frame_chunks(tmp_path, monkeypatch):
+    """Blocks should hold whole frames, grouped if they are small."""
+    IMAGES["stack.tif"](tmp_path / "stack.tif")
+    pixels = lazy_array(tmp_path / "stack.tif")
+    assert pixels.chunks == ((5,), (32,), (24,))
+    monkeypatch.setattr(image_data, "CHUNK_BYTES", 2 * 32 * 24 * 2)
+    pixels = lazy_array(tmp_path / "stack.tif")
+    assert pixels.chunks == ((2, 2, 1), (32,), (24,))
+    monkeypatch.undo()
+    # GIF frames depend on the ones before, so they are read together
+    IMAGES["animated.gif"](tmp_path / "animated.gif")
+    pixels = lazy_array(tmp_path / "animated.gif")
+    assert pixels.chunks == ((4,), (3,), (16,), (48,))
+    monkeypatch.setattr(image_data, "CHUNK_BYTES", 2 * 3 * 16 * 48)
+    pixels = lazy_array(tmp_path / "animated.gif")
+    assert pixels.chunks == ((2, 2), (3,), (16,), (48,))
+
+
+def test_thumbnail_pages(tmp_path):
+    """Only the first series of a TIFF file should be read."""
+    path = tmp_path / "stack.tif"
+    with tifffile.TiffWriter(path) as tif:
+        tif.write(stack)
+        tif.write(stack[0, ::4, ::4], subfiletype=1)
+    pixels = lazy_array(path)
+    assert pixels.shape == stack.shape
+    np.testing.assert_array_equal(pixels.compute(), stack)
+
+
+def test_big_endian(tmp_path):
+    path = tmp_path / "stack.tif"
+    tifffile.imwrite(path, stack, byteorder=">")
+    pixels = lazy_array(path)
+    assert pixels.dtype == np.dtype("u2")
+    np.testing.assert_array_equal(pixels[1:3].compute(), stack[1:3])
+
+
+def test_last_frame(tmp_path):
+    """Reading a frame should not walk the pages before it."""
+    path = tmp_path / "stack.tif"
+    IMAGES["stack.tif"](path)
+    pixels = lazy_array(path)
+    frame = mock.patch.object(tifffile, "TiffFrame", wraps=tifffile.TiffFrame)
+    seek = mock.patch.object(tifffile.TiffPages, "_seek")
+    with frame as frame, seek as seek:
+        np.testing.assert_array_equal(pixels[4].compute(), stack[4])
+    assert [call.kwargs["index"] for call in frame.call_args_list] == [4]
+    seek.assert_not_called()
+
+
+def test_strip_chunks(tmp_path, monkeypatch):
+    """Whole TIFF strips should be merged into blocks of about CHUNK_BYTES."""
+    path = tmp_path / "zlib.tif"
+    IMAGES["zlib.tif"](path)
+    # Each strip is 8 rows of 48 uint16 pixels
+    monkeypatch.setattr(image_data, "CHUNK_BYTES", 3 * 8 * 48 * 2)
+    assert lazy_array(path).chunks == ((24, 24, 16), (48,))
+    # Strips are never split up
+    monkeypatch.setattr(image_data, "CHUNK_BYTES", 1)
+    assert lazy_array(path).chunks == ((8,) * 8, (48,))
+
+
+def test_rows_decoded(tmp_path, monkeypatch, strip_reads):
+    """Only the strips holding the selected rows should be decoded."""
+    path = tmp_path / "zlib.tif"
+    IMAGES["zlib.tif"](path)
+    monkeypatch.setattr(image_data, "CHUNK_BYTES", 1)
+    pixels = lazy_array(path)
+    strip_reads.clear()
+    np.testing.assert_array_equal(pixels[10:20].compute(), gray16[10:20])
+    assert sorted(decoded_strips(strip_reads)) == ["1.0", "2.0"]
+
+
+def test_frames_decoded(tmp_path):
+    """Only the selected frames of a stack should be decoded."""
+    path = tmp_path / "stack.tif"
+    IMAGES["stack.tif"](path)
+    pixels = lazy_array(path)
+    tiff_frame = mock.patch.object(
+        LazyImage, "tiff_frame", autospec=True, side_effect=LazyImage.tiff_frame
+    )
+    with tiff_frame as tiff_frame:
+        np.testing.assert_array_equal(pixels[2:4].compute(), stack[2:4])
+    assert [call.args[3] for call in tiff_frame.call_args_list] == [2, 3]
+
+
+def test_pil_frames_decoded(tmp_path):
+    """A block of GIF frames should be decoded in order, from one file."""
+    path = tmp_path / "animated.gif"
+    IMAGES["animated.gif"](path)
+    with Image.open(path) as image:
+        lazy = LazyImage(path, image)
+    pil_frame = mock.patch.object(
+        LazyImage, "pil_frame", autospec=True, side_effect=LazyImage.pil_frame
+    )
+    open_image = mock.patch.object(image_data.Image, "open", wraps=Image.open)
+    with pil_frame as pil_frame, open_image as open_image:
+        assert lazy[1:3].shape == (2, 3, 16, 48)
+    assert [call.args[2] for call in pil_frame.call_args_list] == [1, 2]
+    open_image.assert_called_once()
+
+
+def test_memmap(tmp_path):
+    """Uncompressed TIFF pages should be memory-mapped, not decoded."""
+    IMAGES["plain.tif"](tmp_path / "plain.tif")
+    IMAGES["zlib.tif"](tmp_path / "zlib.tif")
+    memmap = mock.patch.object(image_data.numpy, "memmap", wraps=np.memmap)
+    open_zarr = mock.patch.object(image_data.zarr, "open", wraps=image_data.zarr.open)
+    with memmap as memmap, open_zarr as open_zarr:
+        pixels = lazy_array(tmp_path / "plain.tif")
+        np.testing.assert_array_equal(pixels[4:8].compute(), gray16[4:8])
+        memmap.assert_called_once()
+        pixels = lazy_array(tmp_path / "zlib.tif")
+        open_zarr.reset_mock()
+        np.testing.assert_array_equal(pixels[4:8].compute(), gray16[4:8])
+        memmap.assert_called_once()
+        open_zarr.assert_called_once()
+
+
+def test_pil_fallback(tmp_path, monkeypatch):
+    """TIFF files that tifffile cannot lay out are decoded by PIL."""
+    path = tmp_path / "contig_rgb.tif"
+    IMAGES["contig_rgb.tif"](path)
+    monkeypatch.setattr(image_data, "tiff_layout", mock.Mock(side_effect=ValueError))
+    with Image.open(path) as image:
+        lazy = LazyImage(path, image)
+    assert lazy.order is None
+    np.testing.assert_array_equal(lazy[:, 2:4], np.moveaxis(rgb, -1, 0)[:, 2:4])
+
+
+@pytest.mark.parametrize("name", ["stack.tif", "animated.gif"])
+def test_empty_frames(tmp_path, name):
+    IMAGES[name](tmp_path / name)
+    with Image.open(tmp_path / name) as image:
+        lazy = LazyImage(tmp_path / name, image)
+    pixels = lazy[3:3, 2:5]
+    frame_shape = np.empty(lazy.shape[1:])[2:5].shape
+    assert pixels.shape == (0, *frame_shape)
+    assert pixels.dtype == lazy.dtype
+
+
+@pytest.fixture()
+def image_cache(tmp_path, monkeypatch):
+    """Keep the sidecar cache of image metadata in a temporary directory."""
+    cache_dir = tmp_path / "image_cache"
+    monkeypatch.setattr(image_data, "CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def test_cache_key(tmp_path, image_cache):
+    """Cached metadata should belong to one version of one file."""
+    path = tmp_path / "a.png"
+    write_pil(path, gray16)
+    os.utime(path, ns=(10**9, 10**9))
+    key = image_data.cache_path(path, "extrema")
+    assert key.parent == image_cache
+    assert key == image_data.cache_path(path, "extrema")
+    assert key != image_data.cache_path(path, "level1", ".npy")
+    # Same contents and times, different path
+    other = tmp_path / "b.png"
+    shutil.copy2(path, other)
+    assert image_data.cache_path(other, "extrema") != key
+    # Modified
+    os.utime(path, ns=(2 * 10**9, 2 * 10**9))
+    assert image_data.cache_path(path, "extrema") != key
+    # Resized, with the original modification time
+    with open(path, "ab") as f:
+        f.write(b"\0")
+    os.utime(path, ns=(10**9, 10**9))
+    assert image_data.cache_path(path, "extrema") != key
+
+
+def test_eager_extrema(tmp_path, image_cache):
+    """Extrema should be in the metadata at registration, like PIL's."""
+    path = tmp_path / "rgb.bmp"
+    write_pil(path, rgb)
+    with Image.open(path) as image:
+        expected = [list(band) for band in image.getextrema()]
+    assert image_data.read_image_full(path).metadata()["extrema"] == expected
+    # Registering again reads them from the cache, without decoding
+    with mock.patch.object(image_data, "array_extrema") as array_extrema:
+        adapter = image_data.read_image(path, extrema="eager")
+        assert adapter.metadata()["extrema"] == expected
+    array_extrema.assert_not_called()
+
+
+def test_lazy_extrema(tmp_path, image_cache):
+    path = tmp_path / "gray16.png"
+    write_pil(path, gray16)
+    adapter = image_data.read_image(path, extrema="lazy")
+    assert "extrema" not in adapter.metadata()
+    # Reading part of the image is not enough
+    adapter.read(NDSlice(slice(0, 10)))
+    assert "extrema" not in adapter.metadata()
+    np.testing.assert_array_equal(adapter.read(), gray16)
+    expected = [int(gray16.min()), int(gray16.max())]
+    assert adapter.metadata()["extrema"] == expected
+    # Files read (or registered) again get them from the cache
+    adapter = image_data.read_image(path, extrema="lazy")
+    assert adapter.metadata()["extrema"] == expected
+
+
+def test_registration_decodes_nothing(tmp_path, image_cache):
+    """The default reader should register a file from its header alone."""
+    path = tmp_path / "stack.tif"
+    tifffile.imwrite(path, np.arange(5 * 8 * 8, dtype="u2").reshape(5, 8, 8))
+    getitem = mock.patch.object(
+        image_data.LazyImage, "__getitem__", side_effect=AssertionError
+    )
+    array_extrema = mock.patch.object(image_data, "array_extrema")
+    with getitem as getitem, array_extrema as array_extrema:
+        adapter = image_data.read_image(path)
+        metadata = adapter.metadata()
+    getitem.assert_not_called()
+    array_extrema.assert_not_called()
+    assert "extrema" not in metadata
+    # Once cached (e.g. by a full read), registering again serves them
+    adapter.read()
+    assert image_data.read_image(path).metadata()["extrema"] == [0, 319]
+
+
+def test_no_extrema(tmp_path, image_cache):
+    path = tmp_path / "gray16.png"
+    write_pil(path, gray16)
+    image_data.read_image(path, extrema="eager").metadata()
+    adapter = image_data.read_image(path, extrema="none")
+    adapter.read()
+    assert "extrema" not in adapter.metadata()
+    adapter = image_data.read_image_basic(path)
+    assert "extrema" not in adapter.metadata()
+    with pytest.raises(ValueError):
+        image_data.image_reader(extrema="sometimes")
+
+
+def test_exif(tmp_path, image_cache):
+    path = tmp_path / "exif.png"
+    exif = Image.Exif()
+    exif[0x0110] = "Test camera"  # Model
+    write_pil(path, gray16, exif=exif)
+    assert image_data.read_image(path).metadata()["exif"] == {"Model": "Test camera"}
+    assert "exif" not in image_data.read_image(path, exif=False).metadata()
+
+
+def test_downsample():
+    pixels = np.arange(5 * 7, dtype="u2").reshape(5, 7)
+    small = image_data.downsample(pixels)
+    # The odd last row and column are dropped
+    assert small.shape == (2, 3)
+    assert small.dtype == pixels.dtype
+    assert small[0, 0] == np.rint(np.mean([0, 1, 7, 8]))
+    np.testing.assert_allclose(
+        small, pixels[:4, :6].reshape(2, 2, 3, 2).mean(axis=(1, 3)), atol=0.5
+    )
+    # Only the last two axes (rows and columns) get smaller
+    small = image_data.downsample(np.zeros((3, 4, 8, 6), dtype="f4"))
+    assert small.shape == (3, 4, 4, 3)
+
+
+def test_pyramid_shapes(monkeypatch):
+    monkeypatch.setattr(image_data, "THUMBNAIL_SIZE", 100)
+    assert image_data.pyramid_shapes((3, 500, 300)) == [
+        (3, 250, 150),
+        (3, 125, 75),
+        (3, 62, 37),
+    ]
+    # Small enough already
+    assert image_data.pyramid_shapes((100, 80)) == []
+    # Don't go below one pixel
+    assert image_data.pyramid_shapes((1000, 2)) == [(500, 1)]
+
+
+@pytest.fixture()
+def pyramid_stack(tmp_path, image_cache, monkeypatch):
+    """A TIFF stack with three levels of thumbnails."""
+    monkeypatch.setattr(image_data, "THUMBNAIL_SIZE", 4)
+    path = tmp_path / "stack.tif"
+    IMAGES["stack.tif"](path)
+    return path
+
+
+def test_pyramid_levels(pyramid_stack):
+    container = image_data.read_image_pyramid(pyramid_stack)
+    np.testing.assert_array_equal(container["image"].read(), stack)
+    thumbnails = container["thumbnails"]
+    assert list(thumbnails) == ["1", "2", "3"]
+    expected = stack
+    for level in ["1", "2", "3"]:
+        expected = image_data.downsample(expected)
+        assert thumbnails[level].structure().shape == expected.shape
+        assert thumbnails[level].metadata()["downsample"] == 2 ** int(level)
+        np.testing.assert_array_equal(thumbnails[level].read(), expected)
+
+
+def test_pyramid_frames(pyramid_stack):
+    """Levels should be built one frame at a time, only as needed."""
+    pyramid = image_data.read_image_pyramid(pyramid_stack)
+    with mock.patch.object(
+        image_data, "downsample", wraps=image_data.downsample
+    ) as downsample:
+        pixels = pyramid["thumbnails"]["2"].read()
+    # Levels 1 and 2, each one frame at a time, but not level 3
+    assert [call.args[0].shape for call in downsample.call_args_list] == [
+        *[(32, 24)] * 5,
+        *[(16, 12)] * 5,
+    ]
+    np.testing.assert_array_equal(
+        pixels, image_data.downsample(image_data.downsample(stack))
+    )
+    assert image_data.load_cached(pyramid_stack, "level2", ".npy") is not None
+    assert image_data.load_cached(pyramid_stack, "level3", ".npy") is None
+
+
+def test_pyramid_cache(pyramid_stack, image_cache):
+    """Cached levels should be memory-mapped, without decoding the image."""
+    image_data.read_image_pyramid(pyramid_stack)["thumbnails"]["1"].read()
+    # Only finished levels are left in the cache
+    assert [path.suffix for path in image_cache.iterdir()] == [".npy"]
+    pyramid = image_data.read_image_pyramid(pyramid_stack)
+    with mock.patch.object(LazyImage, "__getitem__") as getitem:
+        level = pyramid["thumbnails"]["1"]
+        pixels = image_data.ImagePyramid(pyramid_stack, stack).level(1)
+        np.testing.assert_array_equal(level.read(), pixels)
+    getitem.assert_not_called()
+    assert isinstance(pixels, np.memmap)
+
+
+def test_pyramid_read_only(pyramid_stack, monkeypatch):
+    """Thumbnails should still work if the cache cannot be written."""
+    monkeypatch.setattr(
+        image_data, "partial_cache_file", mock.Mock(side_effect=PermissionError)
+    )
+    pyramid = image_data.read_image_pyramid(pyramid_stack)
+    np.testing.assert_array_equal(
+        pyramid["thumbnails"]["1"].read(), image_data.downsample(stack)
+    )
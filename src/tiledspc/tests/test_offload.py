@@ -0,0 +1,37 @@
+import threading
+
+import numpy as np
+import pytest
+
+from tiledspc.serialization.offload import (
+    ENCODER_POOLS,
+    file_writer,
+    run_encoder,
+    run_writer,
+)
+from tiledspc.serialization.tsv import encode_chunks
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pool", ENCODER_POOLS)
+async def test_run_encoder(pool):
+    arrays = {"energy": np.linspace(8300, 8400, num=50), "I0": np.arange(50)}
+    chunks = await run_encoder(
+        encode_chunks, arrays, columns=["energy", "I0"], precision=6, pool=pool
+    )
+    assert chunks == encode_chunks(arrays, columns=["energy", "I0"], precision=6)
+
+
+@pytest.mark.asyncio
+async def test_unknown_encoder_pool():
+    with pytest.raises(ValueError):
+        await run_encoder(print, pool="gpu")
+
+
+@pytest.mark.asyncio
+async def test_file_writer():
+    """Writes should happen off the event loop, always on the same thread."""
+    with file_writer() as writer:
+        threads = [await run_writer(writer, threading.get_ident) for _ in range(3)]
+    assert len(set(threads)) == 1
+    assert threads[0] != threading.get_ident()
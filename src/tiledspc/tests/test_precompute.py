@@ -0,0 +1,68 @@
+import pytest
+from tiled.catalog.adapter import CatalogContainerAdapter
+
+from tiledspc.serialization import settings
+from tiledspc.serialization.cache import default_cache
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.precompute import (
+    find_finished_runs,
+    precompute,
+    render_exports,
+)
+from tiledspc.tests.conftest import xafs_uids
+
+
+@pytest.mark.asyncio
+async def test_find_finished_runs(xafs_catalog):
+    uids = await find_finished_runs(xafs_catalog)
+    # Newest runs come first
+    assert uids == xafs_uids[::-1]
+
+
+@pytest.mark.asyncio
+async def test_find_runs_paged(xafs_catalog, monkeypatch):
+    """Runs should be listed a page at a time, and only up to *limit*."""
+    monkeypatch.setattr(settings, "CATALOG_PAGE_SIZE", 1)
+    items_range = CatalogContainerAdapter.items_range
+    pages = []
+
+    async def spy(self, offset=0, limit=None):
+        pages.append((offset, limit))
+        return await items_range(self, offset, limit)
+
+    monkeypatch.setattr(CatalogContainerAdapter, "items_range", spy)
+    assert await find_finished_runs(xafs_catalog) == xafs_uids[::-1]
+    assert pages == [(0, 1), (1, 1), (2, 1)]
+    pages.clear()
+    assert await find_finished_runs(xafs_catalog, limit=1) == xafs_uids[::-1][:1]
+    assert pages == [(0, 1)]
+
+
+@pytest.mark.asyncio
+async def test_render_exports(xafs_catalog, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_CACHE_DIR", str(tmp_path / "cache"))
+    media_types = await render_exports(xafs_catalog, xafs_uids[0])
+    assert media_types == ["application/x-nexus", "text/x-xdi"]
+    # Now the serializer should not need to touch the catalog
+    run = await xafs_catalog.lookup_adapter([xafs_uids[0]])
+    cache = default_cache()
+    assert cache.stats() == {"hits": 0, "misses": 2}
+    await serialize_nexus(None, metadata=run.metadata(), filter_for_access=None)
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+@pytest.mark.asyncio
+async def test_precompute_queue():
+    """Every run should get rendered, even when the queue fills up."""
+    rendered = []
+
+    async def uids():
+        for idx in range(10):
+            yield f"run{idx}"
+
+    def render(uid):
+        rendered.append(uid)
+        return ["text/x-xdi"]
+
+    await precompute(uids(), render=render, workers=3, queue_size=2)
+    assert sorted(rendered) == sorted(f"run{idx}" for idx in range(10))
@@ -0,0 +1,58 @@
+import tracemalloc
+
+import pytest
+
+from tiledspc.serialization.streaming import file_view, iter_file, spooled_file
+
+export_size = 8 * 2**20
+
+
+@pytest.fixture()
+def traced():
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+def peak_growth(func, *args):
+    """Run *func* and report the most extra memory it had allocated at once."""
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    return result, peak - before
+
+
+@pytest.mark.parametrize("chunk_size", [2 * export_size, 2**16])
+def test_file_view_no_copy(traced, chunk_size):
+    """Handing off an export should not make a full-size copy of it.
+
+    Covers both a spooled file that is still in memory, and one that
+    has rolled over to disk.
+
+    """
+    fd = spooled_file(chunk_size)
+    fd.write(b"\x01" * export_size)
+    view, growth = peak_growth(file_view, fd)
+    assert fd.closed
+    assert len(view) == export_size
+    assert view[:4] == b"\x01\x01\x01\x01"
+    assert growth < export_size / 10
+
+
+def test_file_view_empty():
+    fd = spooled_file(16)
+    fd.write(b"")
+    fd.rollover()
+    assert bytes(file_view(fd)) == b""
+
+
+@pytest.mark.asyncio
+async def test_iter_file():
+    fd = spooled_file(16)
+    fd.write(b"Hello, world!")
+    chunks = [chunk async for chunk in iter_file(fd, chunk_size=5)]
+    assert chunks == [b"Hello", b", wor", b"ld!"]
+    assert fd.closed
@@ -0,0 +1,102 @@
+import logging
+
+import pytest
+from prometheus_client import REGISTRY
+
+from tiledspc.serialization import settings, timing
+from tiledspc.serialization.nexus import serialize_nexus
+from tiledspc.serialization.timing import measure_output, timed
+from tiledspc.serialization.tsv import serialize_xdi
+from tiledspc.tests.test_catalog_tsv import metadata
+
+
+@pytest.fixture()
+def spans(caplog):
+    """The stage names of the timing records that get logged."""
+    caplog.set_level(logging.DEBUG, logger=timing.__name__)
+
+    def stages():
+        return [rec.stage for rec in caplog.records if hasattr(rec, "stage")]
+
+    return stages
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_timed(caplog):
+    caplog.set_level(logging.DEBUG, logger=timing.__name__)
+    with timed("read_table", uid="abc") as span:
+        span.bytes_read = 1024
+    (record,) = caplog.records
+    assert record.stage == "read_table"
+    assert record.duration == span.duration
+    assert record.duration >= 0
+    assert record.bytes_read == 1024
+    assert record.uid == "abc"
+
+
+def test_stage_metrics(monkeypatch):
+    """Spans should only be recorded as metrics when asked."""
+    count = "tiledspc_export_stage_duration_seconds_count"
+    read = "tiledspc_export_read_bytes_total"
+    before = sample(count, stage="test_stage")
+    with timed("test_stage") as span:
+        span.bytes_read = 100
+    assert sample(count, stage="test_stage") == before
+    monkeypatch.setattr(settings, "EXPORT_METRICS", True)
+    before_bytes = sample(read, stage="test_stage")
+    with timed("test_stage") as span:
+        span.bytes_read = 100
+    assert sample(count, stage="test_stage") == before + 1
+    assert sample(read, stage="test_stage") == before_bytes + 100
+
+
+@pytest.mark.asyncio
+async def test_measure_streamed_output(monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_METRICS", True)
+    produced = "tiledspc_export_produced_bytes_total"
+    before = sample(produced, media_type="text/x-test")
+
+    async def chunks():
+        yield b"Hello, "
+        yield b"world!"
+
+    result = measure_output(chunks(), "text/x-test")
+    # Nothing has been sent yet
+    assert sample(produced, media_type="text/x-test") == before
+    assert [chunk async for chunk in result] == [b"Hello, ", b"world!"]
+    assert sample(produced, media_type="text/x-test") == before + 13
+
+
+@pytest.mark.asyncio
+async def test_xdi_stages(xafs_run, spans):
+    await serialize_xdi(xafs_run, metadata=metadata, filter_for_access=None)
+    stages = spans()
+    assert "load_datasets" in stages
+    assert "read_partition" in stages
+    assert "encode_rows" in stages
+
+
+@pytest.mark.asyncio
+async def test_nexus_stages(xafs_run, spans, caplog):
+    buff = await serialize_nexus(xafs_run, metadata=metadata, filter_for_access=None)
+    stages = spans()
+    for stage in [
+        "write_run",
+        "write_metadata",
+        "items_range",
+        "read_table",
+        "write_stream_data",
+        "copy_arrays",
+        "write_file",
+    ]:
+        assert stage in stages
+    # External arrays are counted as they are read
+    (copy_record,) = [
+        rec for rec in caplog.records if getattr(rec, "stage", "") == "copy_arrays"
+    ]
+    assert copy_record.bytes_read > 0
+    (output,) = [rec for rec in caplog.records if hasattr(rec, "bytes_produced")]
+    assert output.bytes_produced == len(buff)